@@ -0,0 +1,84 @@
+"""مقایسه زمان راه‌اندازی: user_data.json قدیمی (indent=2) در برابر snapshot دودویی تنبل
+
+اجرا: python bench/bench_startup.py [10000 100000 1000000]
+فایل‌ها در یک پوشه موقت ساخته و پس از اجرا حذف می‌شوند.
+"""
+import gc
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix="bench-startup-")
+os.chdir(WORKDIR)
+
+import main  # noqa: E402
+
+DEFAULT_SIZES = (10_000, 100_000, 1_000_000)
+
+
+def make_user(i):
+    """رکوردی هم‌شکل کاربران واقعی (قالب JSON قبلی)"""
+    return {
+        "phone": f"9{i:09d}",
+        "name": f"کاربر {i}",
+        "registered_at": "2025-01-01T10:00:00.123456+00:00",
+        "alerts": [],
+        "watch_assets": [{"symbol": "XAU/USD", "period": "1w", "last_processed": "2025-01-02T00:00:00.500000+00:00"}],
+        "CIP": False,
+        "Hotline": i % 3 == 0,
+        "subscription_days": 30,
+        "subscription_start": "2026-10-01",
+        "days_left": 12,
+        "last_alert_sent": None,
+    }
+
+
+def timed(func):
+    started = time.perf_counter()
+    result = func()
+    return time.perf_counter() - started, result
+
+
+def bench(count):
+    legacy_file = f"legacy_{count}.json"
+    with open(legacy_file, "w", encoding="utf-8") as f:
+        json.dump({str(i): make_user(i) for i in range(count)}, f, ensure_ascii=False, indent=2)
+
+    # مسیر قبلی: parse کامل JSON پیش از شروع polling
+    legacy_seconds, legacy = timed(lambda: json.load(open(legacy_file, encoding="utf-8")))
+    del legacy
+    gc.collect()
+
+    # تبدیل یک‌باره به snapshot (همان کاری که اولین فشرده‌سازی انجام می‌دهد)
+    snapshot_file, journal_file = f"users_{count}.snap", f"users_{count}.journal"
+    converter = main.JsonJournalUserRepository(snapshot_file, journal_file, legacy_file)
+    converter.compact(converter.load_all())
+    del converter
+    gc.collect()
+
+    repo = main.JsonJournalUserRepository(snapshot_file, journal_file)
+    snapshot_seconds, users = timed(repo.load_all)
+    lookup_seconds, _ = timed(lambda: users[repo.find_by_phone(f"9{count // 2:09d}")])
+
+    sizes = os.path.getsize(legacy_file) / 2**20, os.path.getsize(snapshot_file) / 2**20
+    print(
+        f"{count:>9,} users: json indent=2 {legacy_seconds:6.2f}s ({sizes[0]:.0f}MB) | "
+        f"snapshot {snapshot_seconds:6.2f}s ({sizes[1]:.0f}MB) | first lookup {lookup_seconds * 1000:.2f}ms"
+    )
+    for path in (legacy_file, snapshot_file, journal_file):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    try:
+        for count in [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES:
+            bench(count)
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(WORKDIR, ignore_errors=True)
@@ -4,10 +4,23 @@ import logging
 import json
 import os
 import asyncio
+import gc
 import re
-from datetime import datetime, timedelta, timezone
-
-import requests
+import signal
+import time
+import hashlib
+import heapq
+import hmac
+import uuid
+import random
+import mmap
+import struct
+import sqlite3
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from datetime import date, datetime, timedelta, timezone
+
+import aiohttp
 from telegram import (
     Update,
     KeyboardButton,
@@ -27,6 +40,7 @@ from telegram.ext import (
     ConversationHandler,
     ChatJoinRequestHandler
 )
+from telegram.error import BadRequest, Forbidden, RetryAfter
 from aiohttp import web
 
 # تنظیمات اصلی
@@ -39,8 +53,36 @@ SUPPORT_ID = os.environ.get("SUPPORT_ID", "@Daniyalkhanzadeh")
 GOOGLE_SHEET_URL = os.environ.get("GOOGLE_SHEET_URL", "https://script.google.com/macros/s/YOUR_SCRIPT_ID/exec")
 GOOGLE_SHEET_URL_REG = os.environ.get("GOOGLE_SHEET_URL_REG", "https://script.google.com/macros/s/YOUR_REG_SCRIPT_ID/exec")
 TWELVE_API_KEY = os.environ.get("TWELVE_API_KEY", "")
+TWELVE_API_URL = os.environ.get("TWELVE_API_URL", "https://api.twelvedata.com")
+MARKET_TIMEOUT_SECONDS = float(os.environ.get("MARKET_TIMEOUT_SECONDS", "15"))
+MARKET_CREDITS_PER_MINUTE = int(os.environ.get("MARKET_CREDITS_PER_MINUTE", "8"))  # سقف اعتبار پلن TwelveData (هر نماد یک اعتبار)
+MARKET_BATCH_MAX_SYMBOLS = int(os.environ.get("MARKET_BATCH_MAX_SYMBOLS", "120"))
+MARKET_BATCH_DELAY_SECONDS = 0.05  # مهلت جمع شدن درخواست‌های هم‌زمان در یک فراخوانی
+MARKET_REFRESH_GRACE_SECONDS = 60
+SHEET_PUSH_SECRET = os.environ.get("SHEET_PUSH_SECRET", "")  # توکن مشترک با Apps Script برای /sheet/push
 PORT = int(os.environ.get("PORT", "10000"))
 
+# تنظیمات کلاینت HTTP گوگل شیت
+SHEET_TIMEOUT_SECONDS = float(os.environ.get("SHEET_TIMEOUT_SECONDS", "30"))
+SHEET_MAX_CONCURRENCY = int(os.environ.get("SHEET_MAX_CONCURRENCY", "8"))
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "20"))
+HTTP_KEEPALIVE_SECONDS = 60
+SHEET_BREAKER_FAILURES = int(os.environ.get("SHEET_BREAKER_FAILURES", "5"))
+SHEET_BREAKER_SLOW_SECONDS = float(os.environ.get("SHEET_BREAKER_SLOW_SECONDS", "10"))
+SHEET_BREAKER_RESET_SECONDS = float(os.environ.get("SHEET_BREAKER_RESET_SECONDS", "30"))
+SHEET_BULK_CHUNK_SIZE = int(os.environ.get("SHEET_BULK_CHUNK_SIZE", "200"))
+SHEET_BULK_PARALLEL = int(os.environ.get("SHEET_BULK_PARALLEL", "3"))
+SHEET_BULK_TIMEOUT_SECONDS = float(os.environ.get("SHEET_BULK_TIMEOUT_SECONDS", "120"))
+SYNC_PROGRESS_INTERVAL_SECONDS = 10
+PUSH_IDEMPOTENCY_CACHE_SIZE = 10000
+SHEET_MIRROR_INTERVAL_SECONDS = float(os.environ.get("SHEET_MIRROR_INTERVAL_SECONDS", "240"))  # صفر = غیرفعال
+OUTBOX_FILE = "sheet_outbox.json"
+OUTBOX_BASE_DELAY_SECONDS = 5
+OUTBOX_MAX_DELAY_SECONDS = 30 * 60
+OUTBOX_POLL_SECONDS = 60
+ENTITLEMENT_CACHE_TTL_SECONDS = float(os.environ.get("ENTITLEMENT_CACHE_TTL_SECONDS", "300"))
+ENTITLEMENT_CACHE_MAX_STALE_SECONDS = float(os.environ.get("ENTITLEMENT_CACHE_MAX_STALE_SECONDS", str(24 * 3600)))
+
 # اطلاعات ارتباطی
 WEBSITE_URL = os.environ.get("WEBSITE_URL", "https://example.com")
 INSTAGRAM_URL = os.environ.get("INSTAGRAM_URL", "https://instagram.com/example")
@@ -51,13 +93,37 @@ DISCOUNT_CODE_10 = os.environ.get("DISCOUNT_CODE_10", "KHZD10")
 DISCOUNT_CODE_20 = os.environ.get("DISCOUNT_CODE_20", "KHZD20")
 
 DATA_FILE = "user_data.json"
+SNAPSHOT_FILE = "user_data.snap"
+JOURNAL_FILE = "user_data.journal"
+SQLITE_FILE = "user_data.sqlite3"
+USER_STORE = os.environ.get("USER_STORE", "json")  # json یا sqlite
+JOURNAL_COMPACT_BYTES = int(os.environ.get("JOURNAL_COMPACT_BYTES", str(4 * 1024 * 1024)))
+JOURNAL_COMPACT_INTERVAL_SECONDS = 600
+FLUSH_INTERVAL_SECONDS = float(os.environ.get("FLUSH_INTERVAL_SECONDS", "2"))
+FLUSH_MAX_DIRTY = int(os.environ.get("FLUSH_MAX_DIRTY", "500"))
 KEYWORDS_FILE = "keywords.json"
 REGISTRATION_OPTIONS_FILE = "registration_options.json"
 REGISTRATIONS_FILE = "registrations.json"
+REGISTRATIONS_INDEX_FILE = "registrations_index.json"
+REGISTRATIONS_MAX_BYTES = int(os.environ.get("REGISTRATIONS_MAX_BYTES", str(5 * 1024 * 1024)))
+REGISTRATIONS_ROTATE_PERIOD = "%Y-%m"  # با تغییر ماه فایل جدید شروع می‌شود
 LINK_EXPIRE_MINUTES = 10
-MAX_LINKS_PER_DAY = 5
+LINK_REUSE_MARGIN_SECONDS = 60  # لینک ذخیره‌شده این مقدار زودتر از انقضای واقعی کنار گذاشته می‌شود
+MAX_LINKS_PER_DAY = 5  # در پنجره لغزان ۲۴ ساعته
+SUBSCRIPTION_REFRESH_PER_HOUR = 6  # سقف همگام‌سازی «اشتراک من» با شیت برای هر کاربر
+RATE_LIMITS_FILE = "rate_limits.json"
 ALERT_INTERVAL_SECONDS = 300
 SUBSCRIPTION_ALERT_DAYS = 3  # تعداد روزهای مانده به پایان اشتراک برای ارسال هشدار
+SUBSCRIPTION_ALERT_REPEAT_SECONDS = 3 * 3600  # فاصله تکرار هشدار در بازه هشدار
+BROADCAST_RATE_PER_SECOND = float(os.environ.get("BROADCAST_RATE_PER_SECOND", "30"))  # سقف کلی تلگرام
+BROADCAST_PER_CHAT_INTERVAL_SECONDS = 1.0  # حداقل فاصله دو پیام به یک چت
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "10"))
+BROADCAST_MAX_ATTEMPTS = 3
+REMOVAL_CHECKPOINT_FILE = "removal_checkpoint.json"
+REMOVAL_INTERVAL_SECONDS = float(os.environ.get("REMOVAL_INTERVAL_SECONDS", "3600"))  # صفر = غیرفعال
+REMOVAL_BATCH_SIZE = 20
+REMOVAL_BATCH_PAUSE_SECONDS = 2
+REMOVAL_DRY_RUN = os.environ.get("REMOVAL_DRY_RUN", "").lower() in ("1", "true", "yes")  # فقط گزارش، بدون حذف
 
 # مراحل گفتگو برای پنل ادمین
 ADMIN_LOGIN, ADMIN_ACTION, SELECT_USER, EDIT_SUBSCRIPTION, EDIT_DISCOUNT, EDIT_KEYWORDS, EDIT_REGISTRATION_OPTIONS = range(7)
@@ -68,22 +134,902 @@ ADMIN_LOGIN, ADMIN_ACTION, SELECT_USER, EDIT_SUBSCRIPTION, EDIT_DISCOUNT, EDIT_K
 # بخش اول: مدیریت داده‌ها (بارگذاری و ذخیره)
 # —————————————————————————————————————————————————————————————————————
 
-def load_data():
-    if os.path.exists(DATA_FILE):
+_today = {"ordinal": 0, "until": 0.0}
+
+def today_ordinal():
+    """ordinal روز جاری UTC؛ فقط با عبور از نیمه‌شب UTC دوباره محاسبه می‌شود"""
+    now = time.time()
+    if now >= _today["until"]:
+        today = datetime.fromtimestamp(now, timezone.utc).date()
+        _today["ordinal"] = today.toordinal()
+        _today["until"] = datetime(today.year, today.month, today.day, tzinfo=timezone.utc).timestamp() + 86400
+    return _today["ordinal"]
+
+def user_expiry_date(user):
+    """تاریخ انقضای اشتراک کاربر (شروع + تعداد روز) یا None"""
+    if isinstance(user, UserRecord):
+        return date.fromordinal(user.expires_on) if user.expires_on else None
+    start = user.get("subscription_start") if user else None
+    if not start:
+        return None
+    try:
+        start_date = datetime.strptime(start, "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        return None
+    return start_date + timedelta(days=user.get("subscription_days", 0) or 0)
+
+# —————————————————————————————————————————————————————————————————————
+# رجیستری کانال‌های اشتراکی (سطوح دسترسی)
+# —————————————————————————————————————————————————————————————————————
+# CHANNEL_TIERS (JSON) می‌تواند هر تعداد کانال تعریف کند، مثلاً:
+# [{"key": "Gold", "chat_id": -100123, "label": "🥇 ورود به کانال Gold", "max_links_per_day": 3}]
+# key همان نام ستون در Google Sheet است؛ bit اگر داده نشود به‌ترتیب اختصاص می‌یابد
+DEFAULT_CHANNEL_TIERS = [
+    {
+        "key": "Hotline", "chat_id": CHANNEL_ID, "bit": 2,
+        "title": "کانال اصلی",
+        "label": "🔑 Hotline ورود به کانال",
+        "button": "Hotlineورود به کانال",
+        "intro": "🔑 لینک دسترسی به کانال",
+        "enable_label": "📡 فعال‌سازی Hotline",
+        "disable_label": "📴 غیرفعال‌سازی Hotline",
+    },
+    {
+        "key": "CIP", "chat_id": CIP_CHANNEL_ID, "bit": 1,
+        "title": "کانال CIP",
+        "label": "🌐 ورود به کانال CIP",
+        "button": "ورود به کانال CIP",
+        "intro": "🌐 لینک دسترسی به کانال CIP",
+        "enable_label": "🔛 فعال‌سازی CIP",
+        "disable_label": "🔘 غیرفعال‌سازی CIP",
+    },
+]
+
+class ChannelTier:
+    """یک سطح اشتراک: کانال، بیت دسترسی، برچسب‌ها و سیاست لینک دعوت"""
+
+    def __init__(self, config, bit):
+        key = config["key"]
+        self.key = key
+        self.chat_id = int(config.get("chat_id") or 0)
+        self.bit = bit
+        self.title = config.get("title", f"کانال {key}")
+        self.label = config.get("label", f"🔑 ورود به کانال {key}")
+        self.button = config.get("button", f"ورود به کانال {key}")
+        self.intro = config.get("intro", f"🔑 لینک دسترسی به کانال {key}")
+        self.enable_label = config.get("enable_label", f"✅ فعال‌سازی {key}")
+        self.disable_label = config.get("disable_label", f"⛔ غیرفعال‌سازی {key}")
+        self.link_minutes = int(config.get("link_minutes", LINK_EXPIRE_MINUTES))
+        self.max_links_per_day = int(config.get("max_links_per_day", MAX_LINKS_PER_DAY))
+
+def load_channel_tiers():
+    raw = os.environ.get("CHANNEL_TIERS")
+    configs = DEFAULT_CHANNEL_TIERS
+    if raw:
         try:
-            with open(DATA_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
+            configs = json.loads(raw)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"CHANNEL_TIERS نامعتبر است: {e}")
+    tiers, used_bits = [], set()
+    for config in configs:
+        bit = config.get("bit")
+        if bit is None:
+            bit = 1
+            while bit in used_bits or any(c.get("bit") == bit for c in configs):
+                bit <<= 1
+        if bit in used_bits or bit & (bit - 1):
+            raise ValueError(f"بیت دسترسی تکراری یا نامعتبر برای {config['key']}")
+        used_bits.add(bit)
+        tiers.append(ChannelTier(config, bit))
+    if len({tier.key for tier in tiers}) != len(tiers):
+        raise ValueError("کلید تکراری در CHANNEL_TIERS")
+    return tiers
+
+CHANNEL_TIERS = load_channel_tiers()
+TIERS_BY_CHAT = {tier.chat_id: tier for tier in CHANNEL_TIERS if tier.chat_id}   # مسیریابی O(1) درخواست عضویت
+TIERS_BY_LABEL = {tier.label: tier for tier in CHANNEL_TIERS}
+TIER_ADMIN_ACTIONS = {
+    **{tier.enable_label: (tier, True) for tier in CHANNEL_TIERS},
+    **{tier.disable_label: (tier, False) for tier in CHANNEL_TIERS},
+}
+
+# —————————————————————————————————————————————————————————————————————
+# مدل فشرده کاربر: __slots__ به‌جای dict، تاریخ‌ها به‌صورت عدد و دسترسی‌ها به‌صورت بیت
+# —————————————————————————————————————————————————————————————————————
+USER_FLAGS = {tier.key: tier.bit for tier in CHANNEL_TIERS}
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MICROSECOND = timedelta(microseconds=1)
+
+def _pack_timestamp(value):
+    """تبدیل زمان ISO (UTC) به میکروثانیه از epoch؛ اگر برگشت‌پذیر نباشد همان متن نگه داشته می‌شود"""
+    if not isinstance(value, str):
+        return value
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return value
+    if parsed.utcoffset() != timedelta(0):
+        return value
+    packed = (parsed - _EPOCH) // _MICROSECOND
+    return packed if _unpack_timestamp(packed) == value else value
+
+def _unpack_timestamp(value):
+    if isinstance(value, int):
+        return (_EPOCH + value * _MICROSECOND).isoformat()
+    return value
+
+def _pack_date(value):
+    """تبدیل تاریخ YYYY-MM-DD به ordinal (رشته خالی → 0)؛ قالب‌های دیگر دست‌نخورده می‌مانند"""
+    if value == "":
+        return 0
+    if not isinstance(value, str):
+        return value
+    try:
+        packed = datetime.strptime(value, "%Y-%m-%d").date().toordinal()
+    except ValueError:
+        return value
+    return packed if _unpack_date(packed) == value else value
+
+def _unpack_date(value):
+    if isinstance(value, int):
+        return datetime.fromordinal(value).date().isoformat() if value else ""
+    return value
+
+class UserRecord:
+    """رکورد یک کاربر با __slots__
+
+    برای سازگاری با هندلرها رابط dict (get، [] و in) با همان کلیدهای قالب JSON
+    قبلی را پیاده می‌کند. to_dict/from_dict تبدیل بدون اتلاف به همان قالب است؛ تنها
+    استثنا شمارنده‌های قدیمی links است که کنار گذاشته می‌شوند (سقف لینک در link_limiters است).
+    days_left ذخیره نمی‌شود و هنگام خواندن از expires_on و روز جاری محاسبه می‌شود.
+    """
+
+    __slots__ = (
+        "phone", "name", "registered_at", "flags", "subscription_days",
+        "subscription_start", "expires_on", "last_alert_sent",
+        "alerts", "watch_assets", "sheet_hash", "extra",
+    )
+
+    def __init__(self):
+        self.phone = ""
+        self.name = ""
+        self.registered_at = None    # میکروثانیه از epoch (یا متن اصلی)
+        self.flags = 0               # بیت‌های USER_FLAGS
+        self.subscription_days = 0
+        self.subscription_start = 0  # ordinal تاریخ شروع؛ صفر یعنی تعریف نشده
+        self.expires_on = 0          # ordinal انقضا (شروع + روزها)؛ days_left هنگام خواندن از آن محاسبه می‌شود
+        self.last_alert_sent = None  # میکروثانیه از epoch (یا متن اصلی)
+        self.alerts = None
+        self.watch_assets = None     # tuple از (symbol, period, last_processed)
+        self.sheet_hash = None       # هش آخرین داده‌ای که شیت تأیید کرده
+        self.extra = None            # کلیدهای ناشناخته برای حفظ داده
+
+    # ——— تبدیل از/به قالب JSON ———
+    @classmethod
+    def from_dict(cls, data):
+        if isinstance(data, cls):
+            return data
+        record = cls()
+        for key, value in data.items():
+            record[key] = value
+        return record
+
+    def to_dict(self):
+        data = {
+            "phone": self.phone,
+            "name": self.name,
+            "registered_at": _unpack_timestamp(self.registered_at),
+            "alerts": list(self.alerts or ()),
+            "watch_assets": self["watch_assets"],
+            "subscription_days": self.subscription_days,
+            "subscription_start": _unpack_date(self.subscription_start),
+            "days_left": self.days_left,  # فقط برای سازگاری قالب؛ هنگام بارگذاری نادیده گرفته می‌شود
+            "last_alert_sent": _unpack_timestamp(self.last_alert_sent),
+        }
+        for key in USER_FLAGS:
+            data[key] = self[key]
+        if self.sheet_hash is not None:
+            data["sheet_hash"] = self.sheet_hash
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    # ——— رابط شبیه dict ———
+    def __getitem__(self, key):
+        if key in USER_FLAGS:
+            return bool(self.flags & USER_FLAGS[key])
+        if key in ("phone", "name", "subscription_days"):
+            return getattr(self, key)
+        if key == "days_left":
+            return self.days_left
+        if key == "sheet_hash" and self.sheet_hash is not None:
+            return self.sheet_hash
+        if key == "subscription_start":
+            return _unpack_date(self.subscription_start)
+        if key in ("registered_at", "last_alert_sent"):
+            return _unpack_timestamp(getattr(self, key))
+        if key == "alerts":
+            return list(self.alerts or ())
+        if key == "watch_assets":
+            return [
+                {"symbol": w[0], "period": w[1], "last_processed": _unpack_timestamp(w[2])}
+                if isinstance(w, tuple) else dict(w)
+                for w in self.watch_assets or ()
+            ]
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in USER_FLAGS:
+            if value:
+                self.flags |= USER_FLAGS[key]
+            else:
+                self.flags &= ~USER_FLAGS[key]
+        elif key in ("phone", "name", "sheet_hash"):
+            setattr(self, key, value)
+        elif key == "subscription_days":
+            self.subscription_days = value
+            self._update_expiry()
+        elif key == "subscription_start":
+            self.subscription_start = _pack_date(value)
+            self._update_expiry()
+        elif key == "days_left":
+            pass  # مقدار مشتق از expires_on است
+        elif key in ("registered_at", "last_alert_sent"):
+            setattr(self, key, _pack_timestamp(value))
+        elif key == "links":
+            pass  # شمارنده‌های قدیمی لینک؛ اکنون در link_limiters
+        elif key == "alerts":
+            self.alerts = list(value) if value else None
+        elif key == "watch_assets":
+            self.watch_assets = tuple(self._pack_watch(w) for w in value) if value else None
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __repr__(self):
+        return f"UserRecord({self.to_dict()!r})"
+
+    # ——— انقضا و دسترسی ———
+    def _update_expiry(self):
+        try:
+            days = int(self.subscription_days or 0)
+        except (TypeError, ValueError):
+            days = 0
+        start = self.subscription_start
+        if isinstance(start, str):
+            # قالب غیراستاندارد (مثلاً "2026-10-5" از شیت) به همان شکل نگه داشته می‌شود ولی انقضا از تاریخ آن است
+            try:
+                start = datetime.strptime(start, "%Y-%m-%d").date().toordinal()
+            except ValueError:
+                start = 0
+        self.expires_on = start + days if isinstance(start, int) and start else 0
+
+    @property
+    def days_left(self):
+        return max(0, self.expires_on - today_ordinal()) if self.expires_on else 0
+
+    def access_mask(self):
+        """بیت‌های سطوحی که اشتراکشان فعال است (صفر اگر منقضی شده باشد)"""
+        return self.flags if self.expires_on > today_ordinal() else 0
+
+    def has_access(self, flag):
+        """دسترسی فعال به یک نوع اشتراک: یک بیت و یک مقایسه عددی"""
+        return bool(self.access_mask() & USER_FLAGS.get(flag, 0))
+
+    # ——— دارایی‌های تحت نظر ———
+    @staticmethod
+    def _pack_watch(watch):
+        if isinstance(watch, dict) and watch.keys() == {"symbol", "period", "last_processed"}:
+            return (watch["symbol"], watch["period"], _pack_timestamp(watch["last_processed"]))
+        return watch
+
+    def has_watch(self, symbol, period):
+        return any(
+            (w[0], w[1]) == (symbol, period) if isinstance(w, tuple)
+            else (w.get("symbol"), w.get("period")) == (symbol, period)
+            for w in self.watch_assets or ()
+        )
+
+    def add_watch(self, symbol, period, last_processed):
+        watch = (symbol, period, _pack_timestamp(last_processed))
+        self.watch_assets = (self.watch_assets or ()) + (watch,)
+
+# —————————————————————————————————————————————————————————————————————
+# snapshot دودویی کاربران: رکوردهای با پیشوند طول + بارگذاری تنبل
+# —————————————————————————————————————————————————————————————————————
+# قالب فایل: MAGIC | تعداد رکورد (uint32) | رکوردها
+# هر رکورد: طول شناسه (uint16) | طول شماره (uint8) | ordinal انقضا (uint32، صفر=ندارد) | طول داده (uint32)
+#           | شناسه | شماره | JSON فشرده کاربر
+SNAPSHOT_MAGIC = b"UDSNAP1\n"
+_SNAPSHOT_COUNT = struct.Struct(">I")
+_SNAPSHOT_RECORD = struct.Struct(">HBII")
+
+class LazyUserMap(MutableMapping):
+    """دیکشنری کاربران که هر رکورد را فقط هنگام اولین دسترسی decode می‌کند"""
+
+    def __init__(self, buffer=None, raw=None, data=None):
+        self._buffer = buffer
+        self._raw = raw if raw is not None else {}  # شناسه → (offset, length) در buffer یا متن JSON
+        self._data = data if data is not None else {}
+
+    def _raw_bytes(self, raw):
+        if isinstance(raw, tuple):
+            offset, length = raw
+            return self._buffer[offset:offset + length]
+        return raw
+
+    def __getitem__(self, user_id):
+        try:
+            return self._data[user_id]
+        except KeyError:
+            pass
+        raw = self._raw[user_id]
+        user = UserRecord.from_dict(json.loads(self._raw_bytes(raw)))
+        del self._raw[user_id]
+        self._data[user_id] = user
+        return user
+
+    def __setitem__(self, user_id, user):
+        self._raw.pop(user_id, None)
+        self._data[user_id] = UserRecord.from_dict(user)
+
+    def __delitem__(self, user_id):
+        if user_id in self._data:
+            del self._data[user_id]
+        else:
+            del self._raw[user_id]
+
+    def __contains__(self, user_id):
+        return user_id in self._data or user_id in self._raw
+
+    def __iter__(self):
+        yield from list(self._data)
+        yield from list(self._raw)
+
+    def __len__(self):
+        return len(self._data) + len(self._raw)
+
+    def raw_record(self, user_id):
+        """بایت‌های JSON کاربری که هنوز decode نشده (برای کپی مستقیم در snapshot بعدی)"""
+        raw = self._raw.get(user_id)
+        if raw is None:
+            return None
+        raw = self._raw_bytes(raw)
+        return raw.encode("utf-8") if isinstance(raw, str) else raw
+
+    @property
+    def decoded_count(self):
+        return len(self._data)
+
+def read_snapshot(path):
+    """خواندن snapshot با mmap؛ فقط سرآیند رکوردها خوانده می‌شود و داده‌ها decode نمی‌شوند"""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return LazyUserMap(), {}, {}
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if buffer[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        raise ValueError("قالب فایل snapshot نامعتبر است")
+    (count,) = _SNAPSHOT_COUNT.unpack_from(buffer, len(SNAPSHOT_MAGIC))
+    pos = len(SNAPSHOT_MAGIC) + _SNAPSHOT_COUNT.size
+    raw, phones, expiries = {}, {}, {}
+    record = _SNAPSHOT_RECORD
+    # میلیون‌ها شیء کوچک و ماندگار ساخته می‌شود؛ GC دوره‌ای در این حلقه فقط زمان راه‌اندازی را چند برابر می‌کند
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(count):
+            key_len, phone_len, expiry, value_len = record.unpack_from(buffer, pos)
+            pos += record.size
+            user_id = buffer[pos:pos + key_len].decode("utf-8")
+            pos += key_len
+            if phone_len:
+                phones[user_id] = buffer[pos:pos + phone_len].decode("utf-8")
+                pos += phone_len
+            if expiry:
+                expiries[user_id] = expiry
+            raw[user_id] = (pos, value_len)
+            pos += value_len
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return LazyUserMap(buffer, raw), phones, expiries
+
+def write_snapshot(path, records):
+    """نوشتن اتمیک snapshot (فایل موقت + fsync + rename)
+
+    records: دنباله‌ای از (شناسه، شماره، ordinal انقضا، بایت‌های JSON)
+    """
+    parts = []
+    count = 0
+    for user_id, phone, expiry, value in records:
+        key = user_id.encode("utf-8")
+        phone = (phone or "").encode("utf-8")[:255]
+        parts.append(_SNAPSHOT_RECORD.pack(len(key), len(phone), expiry or 0, len(value)))
+        parts.append(key)
+        parts.append(phone)
+        parts.append(value)
+        count += 1
+    tmp_file = path + ".tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(_SNAPSHOT_COUNT.pack(count))
+        f.write(b"".join(parts))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, path)
+
+class JsonJournalUserRepository:
+    """ذخیره کاربران در snapshot دودویی به همراه ژورنال JSON فقط-افزودنی"""
+
+    def __init__(self, snapshot_file, journal_file, legacy_file=None):
+        self.snapshot_file = snapshot_file
+        self.journal_file = journal_file
+        self.legacy_file = legacy_file
+        self.needs_migration = False
+        self._phone_index = {}
+        self._user_phone = {}
+        self._expiry_index = {}
+
+    def _index_meta(self, user_id, phone, expiry_ordinal):
+        old_phone = self._user_phone.pop(user_id, None)
+        if old_phone and self._phone_index.get(old_phone) == user_id:
+            del self._phone_index[old_phone]
+        if phone:
+            self._phone_index[phone] = user_id
+            self._user_phone[user_id] = phone
+        if expiry_ordinal:
+            self._expiry_index[user_id] = expiry_ordinal
+        else:
+            self._expiry_index.pop(user_id, None)
+
+    def _index(self, user_id, user):
+        if user is None:
+            self._index_meta(user_id, None, None)
+            return
+        expiry = user_expiry_date(user)
+        self._index_meta(user_id, user.get("phone"), expiry.toordinal() if expiry else None)
+
+    def _load_snapshot(self):
+        if os.path.exists(self.snapshot_file):
+            try:
+                data, phones, expiries = read_snapshot(self.snapshot_file)
+                # ایندکس‌ها هنگام بارگذاری خالی‌اند؛ مستقیم از سرآیندها ساخته می‌شوند
+                self._user_phone = phones
+                self._phone_index = {phone: user_id for user_id, phone in phones.items()}
+                self._expiry_index = expiries
+                return data
+            except Exception as e:
+                logging.error(f"خطا در بارگیری snapshot داده‌ها: {e}")
+                return LazyUserMap()
+
+        if self.legacy_file and os.path.exists(self.legacy_file):
+            # فایل JSON قدیمی یک بار خوانده و در اولین فشرده‌سازی به snapshot تبدیل می‌شود
+            try:
+                with open(self.legacy_file, "r", encoding="utf-8") as f:
+                    legacy = json.load(f)
+            except Exception as e:
+                logging.error(f"خطا در بارگیری فایل داده‌ها: {e}")
+                legacy = {}
+            for user_id, user in legacy.items():
+                self._index(user_id, user)
+            self.needs_migration = bool(legacy)
+            return LazyUserMap(data={user_id: UserRecord.from_dict(user) for user_id, user in legacy.items()})
+        return LazyUserMap()
+
+    def load_all(self):
+        """بارگذاری snapshot کاربران و اعمال رکوردهای ژورنال روی آن"""
+        data = self._load_snapshot()
+
+        if os.path.exists(self.journal_file):
+            replayed = 0
+            try:
+                good_end = 0  # انتهای آخرین خط سالم (بایت)
+                torn = unterminated = False
+                with open(self.journal_file, "rb") as f:
+                    for line in f:
+                        if line.strip():
+                            try:
+                                record = json.loads(line)
+                            except ValueError:
+                                # خط ناقص (مثلاً قطع برق هنگام نوشتن) → بقیه ژورنال قابل اعتماد نیست
+                                torn = True
+                                break
+                            if record.get("data") is None:
+                                data.pop(record["id"], None)
+                            else:
+                                data[record["id"]] = record["data"]
+                            self._index(record["id"], record.get("data"))
+                            replayed += 1
+                        good_end += len(line)
+                        unterminated = not line.endswith(b"\n")
+                if torn:
+                    # بریدن قطعه ناقص؛ وگرنه نوشتن بعدی به همان خط می‌چسبد و پس از راه‌اندازی مجدد گم می‌شود
+                    dropped = os.path.getsize(self.journal_file) - good_end
+                    os.truncate(self.journal_file, good_end)
+                    logging.warning(f"رکورد ناقص در ژورنال داده‌ها یافت شد؛ {dropped} بایت از انتهای ژورنال حذف شد")
+                elif unterminated:
+                    with open(self.journal_file, "ab") as f:
+                        f.write(b"\n")
+            except Exception as e:
+                logging.error(f"خطا در بارگیری ژورنال داده‌ها: {e}")
+            if replayed:
+                logging.info(f"{replayed} رکورد از ژورنال داده‌ها بازخوانی شد")
+        return data
+
+    def upsert_many(self, records):
+        """افزودن وضعیت چند کاربر به انتهای ژورنال در یک نوبت نوشتن (None یعنی حذف)"""
+        lines = [
+            json.dumps(
+                {"id": user_id, "data": user.to_dict() if user is not None else None},
+                ensure_ascii=False, separators=(",", ":")
+            ) + "\n"
+            for user_id, user in records.items()
+        ]
+        try:
+            with open(self.journal_file, "a", encoding="utf-8") as f:
+                f.write("".join(lines))
         except Exception as e:
-            logging.error(f"خطا در بارگیری فایل داده‌ها: {e}")
-            return {}
-    return {}
+            logging.error(f"خطا در نوشتن ژورنال داده‌ها: {e}")
+            return False
+        for user_id, user in records.items():
+            self._index(user_id, user)
+        return True
+
+    def _snapshot_records(self, data):
+        raw_record = data.raw_record if isinstance(data, LazyUserMap) else (lambda user_id: None)
+        for user_id in data:
+            value = raw_record(user_id)
+            if value is None:
+                user = data[user_id]
+                value = json.dumps(user.to_dict(), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            yield user_id, self._user_phone.get(user_id), self._expiry_index.get(user_id), value
+
+    def compact(self, data):
+        """نوشتن snapshot کامل و خالی کردن ژورنال"""
+        try:
+            # رکوردهایی که decode نشده‌اند بدون parse مستقیم کپی می‌شوند
+            write_snapshot(self.snapshot_file, self._snapshot_records(data))
+            open(self.journal_file, "w", encoding="utf-8").close()
+            self.needs_migration = False
+            return True
+        except Exception as e:
+            logging.error(f"خطا در ذخیره فایل داده‌ها: {e}")
+            return False
+
+    def pending_bytes(self):
+        if self.needs_migration:
+            return JOURNAL_COMPACT_BYTES
+        try:
+            return os.path.getsize(self.journal_file)
+        except OSError:
+            return 0
+
+    def find_by_phone(self, phone):
+        return self._phone_index.get(phone)
+
+    def expiring_between(self, first_day, last_day):
+        """(شناسه، تاریخ انقضا) کاربرانی که انقضایشان در بازه [first_day, last_day] است"""
+        first, last = first_day.toordinal(), last_day.toordinal()
+        return [
+            (user_id, date.fromordinal(expiry)) for user_id, expiry in self._expiry_index.items()
+            if first <= expiry <= last
+        ]
+
+    def close(self):
+        pass
+
+class SqliteUserRepository:
+    """ذخیره کاربران در SQLite (حالت WAL) با ایندکس روی شماره و تاریخ انقضا"""
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.conn = sqlite3.connect(db_file)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                user_id TEXT PRIMARY KEY,
+                phone TEXT,
+                expires_on TEXT,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_users_phone ON users(phone);
+            CREATE INDEX IF NOT EXISTS idx_users_expires_on ON users(expires_on);
+            """
+        )
+        self._drop_days_left()
+
+    def _drop_days_left(self):
+        """ستون days_left نسخه قبلی فقط هنگام upsert نوشته می‌شد و کهنه می‌ماند؛ days_left از expires_on محاسبه می‌شود"""
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(users)")]
+        if "days_left" not in columns:
+            return
+        try:
+            with self.conn:
+                self.conn.execute("DROP INDEX IF EXISTS idx_users_days_left")
+                self.conn.execute("ALTER TABLE users DROP COLUMN days_left")
+        except sqlite3.Error as e:
+            # SQLite قدیمی‌تر از 3.35: ستون با مقدار پیش‌فرض می‌ماند ولی دیگر نوشته یا خوانده نمی‌شود
+            logging.warning(f"حذف ستون days_left از SQLite ممکن نشد: {e}")
+
+    def _row(self, user_id, user):
+        expiry = user_expiry_date(user)
+        return (
+            user_id,
+            user.get("phone") or None,
+            expiry.isoformat() if expiry else None,
+            json.dumps(user.to_dict(), ensure_ascii=False, separators=(",", ":")),
+        )
+
+    def load_all(self):
+        (count,) = self.conn.execute("SELECT COUNT(*) FROM users").fetchone()
+        if count == 0 and any(os.path.exists(f) for f in (SNAPSHOT_FILE, DATA_FILE, JOURNAL_FILE)):
+            # اولین اجرا با SQLite → انتقال داده‌های قبلی JSON
+            legacy = JsonJournalUserRepository(SNAPSHOT_FILE, JOURNAL_FILE, DATA_FILE).load_all()
+            if legacy:
+                self.upsert_many(legacy)
+                logging.info(f"{len(legacy)} کاربر از فایل JSON به SQLite منتقل شد")
+        # متن JSON هر کاربر فقط هنگام اولین دسترسی decode می‌شود
+        raw = dict(self.conn.execute("SELECT user_id, data FROM users"))
+        return LazyUserMap(raw=raw)
+
+    def upsert_many(self, records):
+        """upsert سطری کاربران در یک تراکنش (None یعنی حذف)"""
+        upserts = [self._row(user_id, user) for user_id, user in records.items() if user is not None]
+        deletes = [(user_id,) for user_id, user in records.items() if user is None]
+        try:
+            with self.conn:
+                self.conn.executemany(
+                    """
+                    INSERT INTO users (user_id, phone, expires_on, data)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        phone = excluded.phone,
+                        expires_on = excluded.expires_on,
+                        data = excluded.data
+                    """,
+                    upserts,
+                )
+                if deletes:
+                    self.conn.executemany("DELETE FROM users WHERE user_id = ?", deletes)
+            return True
+        except sqlite3.Error as e:
+            logging.error(f"خطا در ذخیره کاربران در SQLite: {e}")
+            return False
+
+    def compact(self, data):
+        """انتقال WAL به فایل اصلی پایگاه داده"""
+        try:
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            return True
+        except sqlite3.Error as e:
+            logging.error(f"خطا در checkpoint پایگاه داده: {e}")
+            return False
+
+    def pending_bytes(self):
+        try:
+            return os.path.getsize(self.db_file + "-wal")
+        except OSError:
+            return 0
+
+    def find_by_phone(self, phone):
+        row = self.conn.execute("SELECT user_id FROM users WHERE phone = ? LIMIT 1", (phone,)).fetchone()
+        return row[0] if row else None
+
+    def expiring_between(self, first_day, last_day):
+        """(شناسه، تاریخ انقضا) کاربرانی که انقضایشان در بازه [first_day, last_day] است"""
+        rows = self.conn.execute(
+            "SELECT user_id, expires_on FROM users WHERE expires_on BETWEEN ? AND ?",
+            (first_day.isoformat(), last_day.isoformat()),
+        )
+        return [(user_id, date.fromisoformat(expires_on)) for user_id, expires_on in rows]
+
+    def close(self):
+        self.conn.close()
+
+def create_user_repository():
+    """انتخاب backend ذخیره‌سازی کاربران بر اساس USER_STORE"""
+    if USER_STORE == "sqlite":
+        return SqliteUserRepository(SQLITE_FILE)
+    return JsonJournalUserRepository(SNAPSHOT_FILE, JOURNAL_FILE, DATA_FILE)
+
+def load_data():
+    return user_repo.load_all()
 
 def save_data(data):
+    """نوشتن وضعیت کامل کاربران (فقط هنگام فشرده‌سازی)"""
+    return user_repo.compact(data)
+
+# —————————————————————————————————————————————————————————————————————
+# ذخیره‌سازی با تأخیر (write-behind): هندلرها فقط کاربر را «کثیف» علامت می‌زنند
+# —————————————————————————————————————————————————————————————————————
+dirty_users = set()
+dirty_marks = 0
+dirty_event = asyncio.Event()
+
+def mark_dirty(user_id):
+    """علامت‌گذاری کاربر برای ذخیره در نوبت بعدی flush"""
+    global dirty_marks
+    dirty_users.add(user_id)
+    dirty_marks += 1
+    if len(dirty_users) >= FLUSH_MAX_DIRTY:
+        dirty_event.set()
+    schedule_user_alert(user_id)
+    update_entitlement(user_id)
+
+def flush_dirty_users():
+    """نوشتن همه کاربران کثیف در یک نوبت؛ خروجی: تعداد رکوردهای نوشته‌شده"""
+    global dirty_marks
+    if not dirty_users:
+        return 0
+    records = {user_id: users_data.get(user_id) for user_id in dirty_users}
+    marks = dirty_marks
+    if not user_repo.upsert_many(records):
+        return 0  # کاربران کثیف می‌مانند تا نوبت بعد دوباره تلاش شود
+    dirty_users.clear()
+    dirty_marks = 0
+    logging.info(f"💾 {len(records)} رکورد کاربر ذخیره شد ({marks} تغییر در یک نوشتن ادغام شد)")
+    return len(records)
+
+async def dirty_flush_loop():
+    """flush دوره‌ای یا به محض رسیدن تعداد کاربران کثیف به سقف"""
+    while True:
+        try:
+            await asyncio.wait_for(dirty_event.wait(), timeout=FLUSH_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        dirty_event.clear()
+        try:
+            flush_dirty_users()
+            save_rate_limits()
+        except Exception as e:
+            logging.error(f"خطا در ذخیره کاربران کثیف: {e}")
+
+# —————————————————————————————————————————————————————————————————————
+# محدودکننده نرخ با پنجره لغزان (برای عملیات محدودشده هر کاربر)
+# —————————————————————————————————————————————————————————————————————
+rate_limiters = {}
+
+class SlidingWindowLimiter:
+    """حداکثر limit رویداد در هر window_seconds ثانیه برای هر کلید (پنجره لغزان دقیق)
+
+    برای هر کلید فقط زمان limit رویداد آخر نگه داشته می‌شود، پس حافظه هر کاربر ثابت است
+    و کلیدهایی که همه رویدادهایشان از پنجره خارج شده حذف می‌شوند.
+    """
+
+    def __init__(self, name, limit, window_seconds):
+        self.name = name
+        self.limit = limit
+        self.window = window_seconds
+        self.dirty = False
+        self._hits = {}  # key → tuple زمان‌ها (قدیمی به جدید)
+        rate_limiters[name] = self
+
+    def _recent(self, key, now):
+        hits = self._hits.get(key, ())
+        if hits and hits[0] <= now - self.window:
+            hits = tuple(t for t in hits if t > now - self.window)
+            if hits:
+                self._hits[key] = hits
+            else:
+                del self._hits[key]
+        return hits
+
+    def allow(self, key, now=None):
+        return len(self._recent(key, now or time.time())) < self.limit
+
+    def hit(self, key, now=None, count=1):
+        now = now or time.time()
+        self._hits[key] = (self._recent(key, now) + (now,) * count)[-self.limit:]
+        self.dirty = True
+
+    def try_acquire(self, key):
+        """ثبت رویداد در صورت مجاز بودن؛ خروجی: آیا مجاز بود"""
+        now = time.time()
+        if not self.allow(key, now):
+            return False
+        self.hit(key, now)
+        return True
+
+    def retry_after(self, key, count=1):
+        """ثانیه تا آزاد شدن ظرفیت count رویداد"""
+        now = time.time()
+        hits = self._recent(key, now)
+        excess = len(hits) + count - self.limit
+        if excess <= 0:
+            return 0
+        return max(0, hits[excess - 1] + self.window - now)
+
+    def prune(self):
+        now = time.time()
+        for key in list(self._hits):
+            self._recent(key, now)
+
+    def to_dict(self):
+        self.prune()
+        return {key: list(hits) for key, hits in self._hits.items()}
+
+    def load(self, data):
+        self._hits = {key: tuple(hits[-self.limit:]) for key, hits in data.items() if hits}
+        self.prune()
+
+link_limiters = {
+    tier.key: SlidingWindowLimiter(f"links:{tier.key}", tier.max_links_per_day, 24 * 3600)
+    for tier in CHANNEL_TIERS
+}
+subscription_refresh_limiter = SlidingWindowLimiter("subscription_refresh", SUBSCRIPTION_REFRESH_PER_HOUR, 3600)
+
+def load_rate_limits():
+    if not os.path.exists(RATE_LIMITS_FILE):
+        return
     try:
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        with open(RATE_LIMITS_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
     except Exception as e:
-        logging.error(f"خطا در ذخیره فایل داده‌ها: {e}")
+        logging.error(f"خطا در بارگیری وضعیت محدودکننده‌ها: {e}")
+        return
+    for name, limiter in rate_limiters.items():
+        limiter.load(data.get(name, {}))
+
+def save_rate_limits():
+    if not any(limiter.dirty for limiter in rate_limiters.values()):
+        return
+    tmp_file = RATE_LIMITS_FILE + ".tmp"
+    try:
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({name: limiter.to_dict() for name, limiter in rate_limiters.items()}, f, separators=(",", ":"))
+        os.replace(tmp_file, RATE_LIMITS_FILE)
+        for limiter in rate_limiters.values():
+            limiter.dirty = False
+    except Exception as e:
+        logging.error(f"خطا در ذخیره وضعیت محدودکننده‌ها: {e}")
+
+def drop_legacy_link_counters():
+    """مهاجرت یک‌باره: حذف شمارنده‌های روزانه links از رکوردهای ذخیره‌شده کاربران
+
+    رکوردها هنگام decode این فیلد را کنار می‌گذارند؛ اینجا فقط رکوردهای خامی که هنوز
+    آن را دارند یک بار بازنویسی می‌شوند. پس از اولین اجرا چیزی برای بازنویسی نمی‌ماند.
+    """
+    if not isinstance(users_data, LazyUserMap):
+        return
+    migrated = 0
+    for user_id in list(users_data):
+        raw = users_data.raw_record(user_id)
+        if raw is not None and b'"links":' in raw:
+            mark_dirty(user_id)  # رکورد decode و بدون links دوباره نوشته می‌شود
+            migrated += 1
+    if migrated:
+        compact_user_store()
+        logging.info(f"شمارنده‌های قدیمی لینک از {migrated} کاربر حذف شد")
+
+def compact_user_store():
+    """فشرده‌سازی ذخیره‌ساز کاربران (ادغام ژورنال یا checkpoint پایگاه داده)"""
+    # ابتدا تغییرات معلق نوشته می‌شوند تا ژورنال/WAL کامل باشد
+    flush_dirty_users()
+    if save_data(users_data):
+        logging.info(f"ذخیره‌ساز کاربران فشرده شد ({len(users_data)} کاربر)")
+
+def find_user_id_by_phone(phone):
+    """جستجوی کاربر با شماره تلفن از طریق ایندکس ذخیره‌ساز"""
+    flush_dirty_users()
+    return user_repo.find_by_phone(phone)
 
 def load_keywords():
     """بارگذاری کلمات کلیدی از فایل JSON"""
@@ -140,33 +1086,112 @@ def save_registration_options(options):
         logging.error(f"خطا در ذخیره فایل گزینه‌های ثبت‌نام: {e}")
         return False
 
+def _empty_registration_index():
+    return {"total": 0, "by_option": {}, "by_user": {}, "segment": "", "offset": 0}
+
+def _count_registration(index, registration_data):
+    option = registration_data.get("option", "")
+    user_id = str(registration_data.get("user_id", ""))
+    index["total"] += 1
+    index["by_option"][option] = index["by_option"].get(option, 0) + 1
+    index["by_user"][user_id] = index["by_user"].get(user_id, 0) + 1
+
+def save_registration_index(index):
+    """ذخیره اتمیک فایل کناری شمارش ثبت‌نام‌ها"""
+    tmp_file = REGISTRATIONS_INDEX_FILE + ".tmp"
+    try:
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(index, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_file, REGISTRATIONS_INDEX_FILE)
+        return True
+    except Exception as e:
+        logging.error(f"خطا در ذخیره ایندکس ثبت‌نام‌ها: {e}")
+        return False
+
+def load_registration_index():
+    """بارگذاری شمارش ثبت‌نام‌ها و اعمال خطوطی که بعد از آخرین ذخیره ایندکس اضافه شده‌اند"""
+    index = _empty_registration_index()
+    if os.path.exists(REGISTRATIONS_INDEX_FILE):
+        try:
+            with open(REGISTRATIONS_INDEX_FILE, "r", encoding="utf-8") as f:
+                index.update(json.load(f))
+        except Exception as e:
+            logging.error(f"خطا در بارگیری ایندکس ثبت‌نام‌ها: {e}")
+
+    if not os.path.exists(REGISTRATIONS_FILE):
+        index["offset"] = 0
+        return index
+
+    size = os.path.getsize(REGISTRATIONS_FILE)
+    if size < index["offset"]:
+        logging.warning("فایل ثبت‌نام‌ها از ایندکس کوچک‌تر است؛ شمارش از ابتدای فایل فعلی ادامه می‌یابد")
+        index["offset"] = 0
+    if size > index["offset"]:
+        # ایندکس عقب‌تر از لاگ است (مثلاً قطع برنامه بین دو نوشتن) → فقط انتهای فایل خوانده می‌شود
+        with open(REGISTRATIONS_FILE, "rb") as f:
+            f.seek(index["offset"])
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # خط ناقص
+                if line.strip():
+                    try:
+                        _count_registration(index, json.loads(line))
+                    except json.JSONDecodeError:
+                        logging.warning("خط خراب در فایل ثبت‌نام‌ها نادیده گرفته شد")
+                index["offset"] += len(line)
+        save_registration_index(index)
+    return index
+
+def rotate_registrations_if_needed(now=None):
+    """چرخش فایل ثبت‌نام‌ها بر اساس حجم یا تغییر دوره زمانی"""
+    now = now or datetime.now(timezone.utc)
+    segment = now.strftime(REGISTRATIONS_ROTATE_PERIOD)
+    if not registration_index["segment"]:
+        registration_index["segment"] = segment
+    if not os.path.exists(REGISTRATIONS_FILE):
+        registration_index["segment"] = segment
+        registration_index["offset"] = 0
+        return
+    size = os.path.getsize(REGISTRATIONS_FILE)
+    if size < REGISTRATIONS_MAX_BYTES and registration_index["segment"] == segment:
+        return
+    base, ext = os.path.splitext(REGISTRATIONS_FILE)
+    rotated = f"{base}-{now.strftime('%Y%m%d-%H%M%S')}{ext}"
+    suffix = 1
+    while os.path.exists(rotated):
+        rotated = f"{base}-{now.strftime('%Y%m%d-%H%M%S')}-{suffix}{ext}"
+        suffix += 1
+    os.replace(REGISTRATIONS_FILE, rotated)
+    registration_index["segment"] = segment
+    registration_index["offset"] = 0
+    logging.info(f"فایل ثبت‌نام‌ها به {rotated} منتقل شد")
+
 def save_registration(registration_data):
-    """ذخیره اطلاعات ثبت‌نام در فایل"""
+    """افزودن یک ثبت‌نام به انتهای فایل (بدون بازنویسی ثبت‌نام‌های قبلی)"""
     try:
-        # بارگذاری ثبت‌نام‌های موجود
-        registrations = []
-        if os.path.exists(REGISTRATIONS_FILE):
-            with open(REGISTRATIONS_FILE, "r", encoding="utf-8") as f:
-                for line in f:
-                    if line.strip():
-                        registrations.append(json.loads(line))
-        
-        # اضافه کردن ثبت‌نام جدید
-        registrations.append(registration_data)
-        
-        # ذخیره تمام ثبت‌نام‌ها
-        with open(REGISTRATIONS_FILE, "w", encoding="utf-8") as f:
-            for reg in registrations:
-                f.write(json.dumps(reg, ensure_ascii=False) + "\n")
+        rotate_registrations_if_needed()
+        line = (json.dumps(registration_data, ensure_ascii=False) + "\n").encode("utf-8")
+        fd = os.open(REGISTRATIONS_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
         
+        _count_registration(registration_index, registration_data)
+        registration_index["offset"] += len(line)
+        save_registration_index(registration_index)
         return True
     except Exception as e:
         logging.error(f"خطا در ذخیره اطلاعات ثبت‌نام: {e}")
         return False
 
+user_repo = create_user_repository()
 users_data = load_data()
 keywords_data = load_keywords()
 registration_options = load_registration_options()
+registration_index = load_registration_index()
+load_rate_limits()
 
 def normalize_phone(phone):
     """نرمال‌سازی شماره تلفن"""
@@ -182,113 +1207,695 @@ def normalize_phone(phone):
         phone = '0' + phone[4:]
     return phone[-10:]  # 10 رقم آخر
 
-async def update_user_in_sheet(user_data):
-    """به‌روزرسانی کاربر در Google Sheet"""
+# —————————————————————————————————————————————————————————————————————
+# کلاینت HTTP مشترک (غیرمسدودکننده) برای فراخوانی‌های Google Sheet
+# —————————————————————————————————————————————————————————————————————
+http_session = None
+sheet_semaphore = asyncio.Semaphore(SHEET_MAX_CONCURRENCY)
+
+async def start_http_session():
+    """ساخت ClientSession مشترک با connection pool و keep-alive"""
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_SIZE,
+            keepalive_timeout=HTTP_KEEPALIVE_SECONDS,
+            ttl_dns_cache=300
+        )
+        http_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=SHEET_TIMEOUT_SECONDS)
+        )
+    return http_session
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+# درخواست‌های هم‌زمان با کلید یکسان (مثلاً دو بار زدن یک دکمه) فقط یک بار اجرا می‌شوند
+_inflight = {}  # کلید → (future, برچسب داده)
+single_flight_stats = {"started": 0, "shared": 0}
+
+def _forget_inflight(key, future):
+    entry = _inflight.get(key)
+    if entry is not None and entry[0] is future:
+        del _inflight[key]
+
+async def single_flight(key, coro_factory, tag=None):
+    """اجرای coro_factory برای کلید؛ فراخوان‌های هم‌زمان با برچسب یکسان منتظر همان نتیجه می‌مانند
+
+    اگر درخواستی با همان کلید ولی برچسب متفاوت (داده جدیدتر) در جریان باشد،
+    ابتدا پایان آن صبر می‌شود و سپس درخواست جدید اجرا می‌شود.
+    """
+    while True:
+        entry = _inflight.get(key)
+        if entry is None:
+            break
+        future, running_tag = entry
+        if running_tag == tag:
+            single_flight_stats["shared"] += 1
+            return await asyncio.shield(future)
+        await asyncio.wait([future])
+
+    future = asyncio.ensure_future(coro_factory())
+    _inflight[key] = (future, tag)
+    future.add_done_callback(lambda f: _forget_inflight(key, f))
+    single_flight_stats["started"] += 1
+    return await asyncio.shield(future)
+
+class SheetUnavailable(Exception):
+    """مدار گوگل شیت باز است و درخواست ارسال نشد"""
+
+class CircuitBreaker:
+    """قطع‌کننده مدار: پس از خطاها یا کندی‌های پیاپی، درخواست‌ها تا مدتی فوراً رد می‌شوند"""
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name, failure_threshold, slow_call_seconds, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.stats = {"success": 0, "failure": 0, "slow": 0, "rejected": 0, "opened": 0}
+
+    def _transition(self, state):
+        if state == self.state:
+            return
+        logging.warning(f"⚡ مدار {self.name}: {self.state} → {state}")
+        self.state = state
+        if state == self.OPEN:
+            self.opened_at = time.monotonic()
+            self.stats["opened"] += 1
+        elif state == self.CLOSED:
+            self.consecutive_failures = 0
+
+    def allow(self):
+        """آیا درخواست می‌تواند ارسال شود؟ در حالت نیمه‌باز فقط یک درخواست آزمایشی مجاز است"""
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self._transition(self.HALF_OPEN)
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.HALF_OPEN and not self.probe_in_flight:
+            self.probe_in_flight = True
+            return True
+        self.stats["rejected"] += 1
+        return False
+
+    def record(self, success, elapsed, latency_sensitive=True):
+        self.probe_in_flight = False
+        slow = latency_sensitive and elapsed >= self.slow_call_seconds
+        if slow:
+            self.stats["slow"] += 1
+        if success and not slow:
+            self.stats["success"] += 1
+            self._transition(self.CLOSED)
+            self.consecutive_failures = 0
+            return
+        self.stats["failure"] += 1
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self._transition(self.OPEN)
+
+    @property
+    def is_open(self):
+        return self.state == self.OPEN and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def snapshot(self):
+        return dict(self.stats, state=self.state, consecutive_failures=self.consecutive_failures)
+
+sheet_breaker = CircuitBreaker(
+    "google_sheet",
+    failure_threshold=SHEET_BREAKER_FAILURES,
+    slow_call_seconds=SHEET_BREAKER_SLOW_SECONDS,
+    reset_timeout=SHEET_BREAKER_RESET_SECONDS
+)
+
+async def sheet_request(method, url, params=None, payload=None, timeout=SHEET_TIMEOUT_SECONDS, latency_sensitive=True):
+    """یک درخواست به Apps Script با سقف هم‌زمانی و قطع‌کننده مدار؛ خروجی: (status, متن پاسخ)
+
+    latency_sensitive=False برای درخواست‌های حجیم (ارسال دسته‌ای، آینه شیت) که کندی‌شان طبیعی است.
+    """
+    session = await start_http_session()
+    async with sheet_semaphore:
+        if not sheet_breaker.allow():
+            raise SheetUnavailable("مدار گوگل شیت باز است")
+        started = time.monotonic()
+        success = False
+        try:
+            async with session.request(
+                method,
+                url,
+                params=params,
+                json=payload,
+                timeout=aiohttp.ClientTimeout(total=timeout)
+            ) as response:
+                text = await response.text()
+                success = response.status < 500
+                return response.status, text
+        finally:
+            sheet_breaker.record(success, time.monotonic() - started, latency_sensitive)
+
+# —————————————————————————————————————————————————————————————————————
+# صف پایدار (outbox) برای نوشتن‌های ناموفق در شیت با تلاش مجدد و backoff
+# —————————————————————————————————————————————————————————————————————
+def load_outbox():
+    if os.path.exists(OUTBOX_FILE):
+        try:
+            with open(OUTBOX_FILE, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            logging.error(f"خطا در بارگیری صف ارسال شیت: {e}")
+    return {}
+
+def save_outbox():
+    tmp_file = OUTBOX_FILE + ".tmp"
     try:
-        payload = {
-            "action": "register",
-            "phone": user_data["phone"],
-            "name": user_data.get("name", ""),
-            "days": user_data.get("subscription_days", 0),
-            "start_date": user_data.get("subscription_start", ""),
-            "days_left": user_data.get("days_left", 0),
-            "CIP": "T" if user_data.get("CIP", False) else "F",
-            "Hotline": "T" if user_data.get("Hotline", False) else "F"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(sheet_outbox, f, ensure_ascii=False, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, OUTBOX_FILE)
+    except Exception as e:
+        logging.error(f"خطا در ذخیره صف ارسال شیت: {e}")
+
+sheet_outbox = load_outbox()
+outbox_event = asyncio.Event()
+outbox_inflight = set()  # کلیدهایی که ارسال مستقیمشان هنوز در جریان است (شاید منتظر sheet_semaphore)
+
+def enqueue_sheet_write(kind, payload, delay=OUTBOX_BASE_DELAY_SECONDS, save=True):
+    """افزودن یک نوشتن به صف؛ نوشتن‌های یک کاربر ادغام می‌شوند و فقط آخرین وضعیت می‌ماند"""
+    key = f"user:{payload['phone']}" if kind == "user" else f"{kind}:{uuid.uuid4().hex}"
+    entry = sheet_outbox.get(key)
+    if entry is None:
+        sheet_outbox[key] = {
+            "kind": kind,
+            "payload": payload,
+            "created_at": time.time(),
+            "attempts": 0,
+            "next_attempt": time.time() + delay,
+            "last_error": None,
         }
+    else:
+        entry["payload"] = payload
+    if save:
+        save_outbox()
+        outbox_event.set()
+    return key
+
+def has_pending_sheet_write(phone):
+    """آیا وضعیت محلی جدیدتری از این کاربر هنوز در صف ارسال به شیت است"""
+    return f"user:{phone}" in sheet_outbox
+
+def outbox_remove(key):
+    if sheet_outbox.pop(key, None) is not None:
+        save_outbox()
+
+def outbox_backoff(attempts):
+    """تأخیر نمایی با jitter: نیمی ثابت و نیمی تصادفی"""
+    delay = min(OUTBOX_MAX_DELAY_SECONDS, OUTBOX_BASE_DELAY_SECONDS * (2 ** attempts))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+async def process_outbox():
+    """ارسال نوشتن‌هایی که زمان تلاش مجددشان رسیده؛ خروجی: تعداد ارسال موفق"""
+    now = time.time()
+    due = [
+        key for key, entry in sheet_outbox.items()
+        if entry["next_attempt"] <= now and key not in outbox_inflight
+    ]
+    sent = 0
+    for key in due:
+        if sheet_breaker.is_open:
+            break  # تا بسته شدن مدار تلاشی انجام نمی‌شود و backoff بی‌دلیل افزایش نمی‌یابد
+        entry = sheet_outbox.get(key)
+        if entry is None:
+            continue
+        payload = entry["payload"]
+        if entry["kind"] == "user":
+            success = await _post_user_payload(payload)
+        else:
+            success = await _post_registration_payload(payload)
+        if sheet_outbox.get(key) is not entry:
+            continue  # در این فاصله حذف شده است
+        if success and entry["payload"] is payload:
+            del sheet_outbox[key]
+            sent += 1
+        elif success:
+            # در حین ارسال وضعیت جدیدتری ادغام شد → همان را فوراً بفرست
+            entry["next_attempt"] = time.time()
+        else:
+            entry["attempts"] += 1
+            entry["last_error"] = datetime.now(timezone.utc).isoformat()
+            entry["next_attempt"] = time.time() + outbox_backoff(entry["attempts"])
+    if due:
+        save_outbox()
+        logging.info(f"📤 صف ارسال شیت: {sent} از {len(due)} مورد ارسال شد، {len(sheet_outbox)} مورد باقی ماند")
+    return sent
+
+async def outbox_loop():
+    while True:
+        if sheet_outbox:
+            next_due = min(entry["next_attempt"] for entry in sheet_outbox.values())
+            timeout = max(0.0, min(OUTBOX_POLL_SECONDS, next_due - time.time()))
+        else:
+            timeout = OUTBOX_POLL_SECONDS
+        try:
+            await asyncio.wait_for(outbox_event.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        outbox_event.clear()
+        try:
+            await process_outbox()
+        except Exception as e:
+            logging.error(f"خطا در پردازش صف ارسال شیت: {e}")
+
+def outbox_status():
+    """عمق صف و سن قدیمی‌ترین مورد (ثانیه)"""
+    oldest = min((entry["created_at"] for entry in sheet_outbox.values()), default=None)
+    by_kind = {}
+    for entry in sheet_outbox.values():
+        by_kind[entry["kind"]] = by_kind.get(entry["kind"], 0) + 1
+    return {
+        "depth": len(sheet_outbox),
+        "oldest_age_seconds": round(time.time() - oldest) if oldest else 0,
+        "by_kind": by_kind,
+    }
+
+def build_sheet_payload(user_data):
+    """داده ارسالی به Google Sheet برای یک کاربر"""
+    return {
+        "action": "register",
+        "phone": user_data["phone"],
+        "name": user_data.get("name", ""),
+        "days": user_data.get("subscription_days", 0),
+        "start_date": user_data.get("subscription_start", ""),
+        "days_left": user_data.get("days_left", 0),
+        **{tier.key: "T" if user_data.get(tier.key, False) else "F" for tier in CHANNEL_TIERS},
+    }
+
+async def _post_user_payload(payload):
+    try:
         logging.info(f"ارسال داده به گوگل شیت: {payload}")
-        response = requests.post(GOOGLE_SHEET_URL, json=payload, timeout=30)
-        logging.info(f"پاسخ گوگل شیت: {response.status_code} - {response.text}")
-        return response.status_code == 200
+        status, text = await sheet_request("POST", GOOGLE_SHEET_URL, payload=payload)
+        logging.info(f"پاسخ گوگل شیت: {status} - {text}")
+        return status == 200
     except Exception as e:
         logging.error(f"خطا در به‌روزرسانی Google Sheet: {e}")
         return False
 
-async def send_registration_to_sheet(name, phone, reg_option):
-    """ارسال اطلاعات ثبت‌نام به Google Sheet مخصوص ثبت‌نام‌ها"""
+def sheet_payload_hash(payload):
+    """هش محتوای داده ارسالی به شیت (مستقل از ترتیب کلیدها)
+
+    days_left هر روز تغییر می‌کند و از start_date و days به دست می‌آید؛ در هش نمی‌آید تا
+    نوشتن بدون تغییر واقعی هر روز برای همه مشترکان دوباره ارسال نشود.
+    """
+    content = {key: value for key, value in payload.items() if key != "days_left"}
+    encoded = json.dumps(content, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.blake2b(encoded, digest_size=8).hexdigest()
+
+sheet_write_stats = {"sent": 0, "skipped": 0}
+
+async def update_user_in_sheet(user_data):
+    """به‌روزرسانی کاربر در Google Sheet
+
+    اگر داده با آخرین داده تأییدشده توسط شیت یکسان باشد، ارسال نمی‌شود.
+    نوشتن‌های هم‌زمان یکسان برای یک کاربر ادغام می‌شوند.
+    """
+    payload = build_sheet_payload(user_data)
+    payload_hash = sheet_payload_hash(payload)
+    if user_data.get("sheet_hash") == payload_hash:
+        sheet_write_stats["skipped"] += 1
+        return True
+    
+    sheet_write_stats["sent"] += 1
+    tag = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+    success = await single_flight(("update", payload["phone"]), lambda: _post_user_payload(payload), tag)
+    if success:
+        user_data["sheet_hash"] = payload_hash
+        # وضعیت قدیمی‌تر در صف نباید بعداً روی این وضعیت نوشته شود
+        outbox_remove(f"user:{payload['phone']}")
+    else:
+        enqueue_sheet_write("user", payload)
+    return success
+
+async def _post_registration_payload(payload):
     try:
-        payload = {
-            "action": "reg",
-            "name": name,
-            "phone": phone,
-            "reg": reg_option
-        }
         logging.info(f"ارسال داده ثبت‌نام به گوگل شیت Reg: {payload}")
-        response = requests.post(GOOGLE_SHEET_URL_REG, json=payload, timeout=30)
-        logging.info(f"پاسخ گوگل شیت برای ثبت‌نام: {response.status_code} - {response.text}")
-        return response.status_code == 200
+        status, text = await sheet_request("POST", GOOGLE_SHEET_URL_REG, payload=payload)
+        logging.info(f"پاسخ گوگل شیت برای ثبت‌نام: {status} - {text}")
+        return status == 200
     except Exception as e:
         logging.error(f"خطا در ارسال ثبت‌نام به Google Sheet: {e}")
         return False
 
+async def send_registration_to_sheet(name, phone, reg_option):
+    """ارسال اطلاعات ثبت‌نام به Google Sheet مخصوص ثبت‌نام‌ها
+
+    ثبت‌نام پیش از ارسال در صف پایدار نوشته می‌شود؛ اگر ارسال ناموفق باشد در صف می‌ماند.
+    """
+    payload = {
+        "action": "reg",
+        "name": name,
+        "phone": phone,
+        "reg": reg_option
+    }
+    # تا پایان همین ارسال (که ممکن است پشت sheet_semaphore منتظر بماند) صف آن را دوباره نمی‌فرستد
+    key = enqueue_sheet_write("reg", payload)
+    outbox_inflight.add(key)
+    try:
+        success = await _post_registration_payload(payload)
+    finally:
+        outbox_inflight.discard(key)
+    if success:
+        outbox_remove(key)
+    return success
+
 async def get_user_from_sheet(phone):
-    """دریافت اطلاعات کاربر از Google Sheet"""
+    """دریافت اطلاعات کاربر از Google Sheet (درخواست‌های هم‌زمان برای یک شماره ادغام می‌شوند)"""
+    phone = normalize_phone(phone)
+    return await single_flight(("get", phone), lambda: _fetch_user_from_sheet(phone))
+
+async def _fetch_user_from_sheet(phone):
     try:
-        phone = normalize_phone(phone)
-        url = f"{GOOGLE_SHEET_URL}?phone={phone}"
-        logging.info(f"دریافت اطلاعات از گوگل شیت: {url}")
-        response = requests.get(url, timeout=30)
-        if response.status_code == 200:
-            logging.info(f"داده دریافتی از گوگل شیت: {response.text}")
-            return response.json()
+        logging.info(f"دریافت اطلاعات از گوگل شیت برای {phone}")
+        status, text = await sheet_request("GET", GOOGLE_SHEET_URL, params={"phone": phone})
+        if status == 200:
+            logging.info(f"داده دریافتی از گوگل شیت: {text}")
+            return json.loads(text)
         else:
-            logging.error(f"خطا در دریافت از گوگل شیت: {response.status_code}")
+            logging.error(f"خطا در دریافت از گوگل شیت: {status}")
     except Exception as e:
         logging.error(f"خطا در دریافت اطلاعات Google Sheet: {e}")
     return None
 
-async def sync_user_data(user_id, user_data):
-    """همگام‌سازی داده‌های کاربر بین سیستم و Google Sheet"""
-    sheet_data = await get_user_from_sheet(user_data["phone"])
-
-    if sheet_data and sheet_data.get("status") == "found":
-        # تبدیل مقادیر به boolean
-        user_data["CIP"] = bool(sheet_data.get("CIP", False))
-        user_data["Hotline"] = bool(sheet_data.get("Hotline", False))
-
-        # تعداد روز اشتراک
+# —————————————————————————————————————————————————————————————————————
+# کش دسترسی کاربران (TTL + stale-while-revalidate) برای کاهش رفت‌وبرگشت به شیت
+# —————————————————————————————————————————————————————————————————————
+entitlement_cache = {}  # شماره تلفن → زمان آخرین همگام‌سازی موفق (monotonic)
+entitlement_cache_stats = {"hit": 0, "stale": 0, "miss": 0, "refresh": 0, "invalidate": 0, "degraded": 0}
+_refreshing_phones = set()
+_background_tasks = set()
+
+def spawn_background(coro):
+    """اجرای یک کوروتین در پس‌زمینه با نگه‌داشتن ارجاع تا پایان اجرا"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+def mark_entitlement_fresh(phone):
+    if phone:
+        entitlement_cache[phone] = time.monotonic()
+
+def invalidate_entitlement(phone):
+    """حذف کاربر از کش (پس از ویرایش ادمین) تا درخواست بعدی مستقیماً از شیت خوانده شود"""
+    if entitlement_cache.pop(phone, None) is not None:
+        entitlement_cache_stats["invalidate"] += 1
+
+# جدول دسترسی در حافظه: user_id → (بیت‌های USER_FLAGS، ordinal انقضا)
+# با هر mark_dirty (ویرایش ادمین، همگام‌سازی شیت، push) به‌روز می‌شود و در اولین نیاز پر می‌شود
+entitlements = {}
+
+def update_entitlement(user_id):
+    user = users_data.get(user_id)
+    if user is None:
+        entitlements.pop(user_id, None)
+    else:
+        entitlements[user_id] = (user.flags, user.expires_on)
+
+def is_entitled(user_id, bit):
+    """تصمیم دسترسی فقط از جدول: یک AND بیتی و یک مقایسه عددی"""
+    entry = entitlements.get(user_id)
+    if entry is None:
+        update_entitlement(user_id)
+        entry = entitlements.get(user_id)
+        if entry is None:
+            return False
+    return bool(entry[0] & bit) and entry[1] > today_ordinal()
+
+def _parse_sheet_flag(value):
+    """ستون‌های دسترسی در شیت به صورت "T"/"F" نوشته می‌شوند؛ bool("F") درست است"""
+    if isinstance(value, str):
+        return value.strip().upper() in ("T", "TRUE", "1", "YES")
+    return bool(value)
+
+def apply_sheet_row(user_data, sheet_data, partial=False):
+    """اعمال یک ردیف Google Sheet روی کاربر؛ خروجی: آیا فیلدی تغییر کرد
+
+    با partial=True فقط ستون‌های موجود در ردیف اعمال می‌شوند (ردیف‌های push که
+    فقط ستون ویرایش‌شده را دارند)؛ در غیر این صورت ستون‌های غایب مقدار پیش‌فرض می‌گیرند.
+    """
+    fields = tuple(USER_FLAGS) + ("subscription_days", "subscription_start")
+    before = tuple(user_data.get(field) for field in fields)
+
+    # تبدیل مقادیر به boolean
+    for tier in CHANNEL_TIERS:
+        if not partial or tier.key in sheet_data:
+            user_data[tier.key] = _parse_sheet_flag(sheet_data.get(tier.key, False))
+
+    # تعداد روز اشتراک
+    if not partial or "days" in sheet_data:
         try:
             user_data["subscription_days"] = int(sheet_data.get("days", 0))
         except:
             user_data["subscription_days"] = 0
 
-        # تاریخ شروع اشتراک
+    # تاریخ شروع اشتراک (days_left از تاریخ انقضا محاسبه می‌شود)
+    if not partial or "start_date" in sheet_data:
         user_data["subscription_start"] = sheet_data.get("start_date", "")
 
-        # محاسبه days_left
-        if user_data["subscription_start"]:
-            try:
-                start_date = datetime.strptime(user_data["subscription_start"], "%Y-%m-%d").date()
-                today = datetime.now(timezone.utc).date()
-                days_passed = (today - start_date).days
-                user_data["days_left"] = max(0, user_data["subscription_days"] - days_passed)
-            except Exception as e:
-                logging.error(f"خطا در محاسبه days_left: {e}")
-                user_data["days_left"] = 0
-        else:
-            user_data["days_left"] = 0
+    # وضعیت محلی اکنون همان وضعیت شیت است
+    user_data["sheet_hash"] = sheet_payload_hash(build_sheet_payload(user_data))
+    return before != tuple(user_data.get(field) for field in fields)
+
+async def _sync_user_from_sheet(user_id, user_data):
+    """همگام‌سازی داده‌های کاربر بین سیستم و Google Sheet"""
+    sheet_data = await get_user_from_sheet(user_data["phone"])
+
+    if sheet_data is None:
+        # شیت در دسترس نیست → آخرین وضعیت محلی معتبر است (نباید به‌عنوان کاربر جدید ثبت شود)
+        logging.warning(f"شیت در دسترس نیست؛ وضعیت محلی کاربر {user_id} استفاده شد")
+        return user_data
+
+    if sheet_data.get("status") == "found":
+        if has_pending_sheet_write(user_data["phone"]):
+            # تغییر محلی هنوز به شیت نرسیده؛ ردیف شیت قدیمی‌تر است و نباید آن را برگرداند
+            logging.info(f"ردیف شیت کاربر {user_id} نادیده گرفته شد (تغییر محلی در صف ارسال است)")
+            mark_entitlement_fresh(user_data["phone"])
+            return user_data
+        apply_sheet_row(user_data, sheet_data)
 
         # ذخیره محلی
         users_data[user_id] = user_data
-        save_data(users_data)
+        mark_dirty(user_id)
 
     else:
         # اگر کاربر در گوگل شیت نبود → ثبت اولیه
         await update_user_in_sheet(user_data)
         users_data[user_id] = user_data
-        save_data(users_data)
+        mark_dirty(user_id)
 
+    mark_entitlement_fresh(user_data["phone"])
     return user_data
 
+async def _refresh_in_background(user_id, user_data):
+    phone = user_data["phone"]
+    try:
+        await single_flight(("sync", user_id), lambda: _sync_user_from_sheet(user_id, user_data))
+    except Exception as e:
+        logging.error(f"خطا در به‌روزرسانی پس‌زمینه کاربر {user_id}: {e}")
+    finally:
+        _refreshing_phones.discard(phone)
+
+async def sync_user_data(user_id, user_data):
+    """دریافت وضعیت کاربر با کش: تازه → فوری، کهنه → فوری + به‌روزرسانی پس‌زمینه، نبود → شیت"""
+    phone = user_data.get("phone")
+    synced_at = entitlement_cache.get(phone)
+    if synced_at is not None:
+        age = time.monotonic() - synced_at
+        if age < ENTITLEMENT_CACHE_TTL_SECONDS:
+            entitlement_cache_stats["hit"] += 1
+            return user_data
+        if age < ENTITLEMENT_CACHE_MAX_STALE_SECONDS:
+            entitlement_cache_stats["stale"] += 1
+            if phone not in _refreshing_phones:
+                _refreshing_phones.add(phone)
+                entitlement_cache_stats["refresh"] += 1
+                spawn_background(_refresh_in_background(user_id, user_data))
+            return user_data
+
+    if sheet_breaker.is_open:
+        # حالت تنزل‌یافته: تصمیم بر اساس آخرین وضعیت محلی، بدون انتظار برای شیت
+        entitlement_cache_stats["degraded"] += 1
+        return user_data
+
+    entitlement_cache_stats["miss"] += 1
+    return await single_flight(("sync", user_id), lambda: _sync_user_from_sheet(user_id, user_data))
+
+# —————————————————————————————————————————————————————————————————————
+# آینه کامل شیت: دریافت دوره‌ای همه ردیف‌ها و اعمال فقط تغییرات
+# —————————————————————————————————————————————————————————————————————
+sheet_mirror_stats = {"runs": 0, "failures": 0, "last_run": None, "last_rows": 0, "last_changed": 0, "total_changed": 0}
+
+async def fetch_all_sheet_rows():
+    """دریافت همه ردیف‌های شیت اشتراک در یک درخواست (action=all)"""
+    status, text = await sheet_request(
+        "GET", GOOGLE_SHEET_URL, params={"action": "all"},
+        timeout=SHEET_BULK_TIMEOUT_SECONDS, latency_sensitive=False
+    )
+    if status != 200:
+        raise RuntimeError(f"وضعیت پاسخ {status}")
+    result = json.loads(text)
+    rows = result.get("rows") if isinstance(result, dict) else result
+    if not isinstance(rows, list):
+        raise ValueError("پاسخ شیت فهرست ردیف‌ها را ندارد")
+    return rows
+
+def reconcile_sheet_rows(rows):
+    """مقایسه ردیف‌های شیت با کاربران محلی بر اساس شماره؛ خروجی: تعداد کاربران تغییر یافته"""
+    flush_dirty_users()
+    changed = 0
+    for row in rows:
+        phone = normalize_phone(str(row.get("phone", "")))
+        if not phone:
+            continue
+        mark_entitlement_fresh(phone)
+        user_id = user_repo.find_by_phone(phone)
+        user = users_data.get(user_id) if user_id else None
+        if user is None or has_pending_sheet_write(phone):
+            continue  # تغییر محلی در صف ارسال جدیدتر از ردیف شیت است
+        if apply_sheet_row(user, row):
+            mark_dirty(user_id)
+            changed += 1
+    return changed
+
+async def sync_sheet_mirror():
+    started = time.monotonic()
+    try:
+        rows = await fetch_all_sheet_rows()
+    except Exception as e:
+        sheet_mirror_stats["failures"] += 1
+        logging.error(f"خطا در دریافت کامل شیت: {e}")
+        return None
+    changed = reconcile_sheet_rows(rows)
+    sheet_mirror_stats["runs"] += 1
+    sheet_mirror_stats["last_run"] = datetime.now(timezone.utc).isoformat()
+    sheet_mirror_stats["last_rows"] = len(rows)
+    sheet_mirror_stats["last_changed"] = changed
+    sheet_mirror_stats["total_changed"] += changed
+    logging.info(
+        f"🪞 آینه شیت به‌روز شد: {len(rows)} ردیف، {changed} کاربر تغییر کرد "
+        f"({time.monotonic() - started:.1f} ثانیه)"
+    )
+    return changed
+
+async def sheet_mirror_loop():
+    while True:
+        await sync_sheet_mirror()
+        await asyncio.sleep(SHEET_MIRROR_INTERVAL_SECONDS)
+
+# —————————————————————————————————————————————————————————————————————
+# ارسال گروهی پیام با رعایت محدودیت نرخ تلگرام
+# —————————————————————————————————————————————————————————————————————
+class TokenBucket:
+    """سطل توکن async: حداکثر rate برداشت در ثانیه با ظرفیت انفجاری capacity"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        """توقف کامل برداشت (پس از RetryAfter که برای کل ربات اعمال می‌شود)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+telegram_send_bucket = TokenBucket(BROADCAST_RATE_PER_SECOND)
+broadcast_stats = {"sent": 0, "blocked": 0, "failed": 0, "retry_after": 0}
+
+class Broadcaster:
+    """ارسال پیام به گروهی از کاربران با سطل توکن مشترک، محدودیت هر چت و همزمانی محدود.
+    bot هر شیئی با متد async send_message است (برای بنچمارک می‌توان Bot جعلی داد)."""
+
+    def __init__(self, bot, bucket=None, concurrency=BROADCAST_CONCURRENCY,
+                 per_chat_interval=BROADCAST_PER_CHAT_INTERVAL_SECONDS):
+        self.bot = bot
+        self.bucket = bucket or telegram_send_bucket
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.per_chat_interval = per_chat_interval
+        self._chat_next = {}  # chat_id → زمان مجاز پیام بعدی
+
+    async def _wait_chat_slot(self, chat_id):
+        now = time.monotonic()
+        slot = max(now, self._chat_next.get(chat_id, 0.0))
+        self._chat_next[chat_id] = slot + self.per_chat_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def send(self, chat_id, **kwargs):
+        """ارسال یک پیام؛ خروجی: (وضعیت، خطا) با وضعیت sent / blocked / failed"""
+        error = None
+        for attempt in range(BROADCAST_MAX_ATTEMPTS):
+            await self._wait_chat_slot(chat_id)
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id=chat_id, **kwargs)
+                broadcast_stats["sent"] += 1
+                return "sent", None
+            except RetryAfter as e:
+                broadcast_stats["retry_after"] += 1
+                error = str(e)
+                logging.warning(f"محدودیت نرخ تلگرام: توقف {e.retry_after} ثانیه")
+                self.bucket.pause(float(e.retry_after))
+            except Forbidden as e:
+                broadcast_stats["blocked"] += 1
+                return "blocked", str(e)
+            except BadRequest as e:
+                broadcast_stats["failed"] += 1
+                return "failed", str(e)
+            except Exception as e:
+                error = str(e)
+                await asyncio.sleep(2 ** attempt)
+        broadcast_stats["failed"] += 1
+        return "failed", error
+
+    async def broadcast(self, messages):
+        """messages: لیست (chat_id, kwargs)؛ خروجی: chat_id → (وضعیت، خطا)"""
+        async def deliver(chat_id, kwargs):
+            async with self.semaphore:
+                return chat_id, await self.send(chat_id, **kwargs)
+
+        results = await asyncio.gather(*(deliver(chat_id, kwargs) for chat_id, kwargs in messages))
+        return dict(results)
+
 # —————————————————————————————————————————————————————————————————————
 # بخش جدید: ارسال هشدار اشتراک
 # —————————————————————————————————————————————————————————————————————
 async def send_subscription_alert(bot, user_id, user_data):
     """ارسال هشدار اتمام اشتراک به کاربر"""
-    subscription_types = []
-    if user_data.get("CIP", False):
-        subscription_types.append("کانال CIP")
-    if user_data.get("Hotline", False):
-        subscription_types.append("کانال اصلی")
+    subscription_types = [tier.title for tier in CHANNEL_TIERS if user_data.get(tier.key, False)]
     
     if not subscription_types:
         return
@@ -318,18 +1925,15 @@ def build_main_menu_keyboard(user_data):
     
     # ردیف اول: اشتراک من و تحلیل بازار
     row1 = ["📅 اشتراک من"]
-    if user_data.get("Hotline", False) and user_data.get("days_left", 0) > 0:
+    if user_data.has_access("Hotline"):
         row1.append("📊 تحلیل بازار")
     keyboard.append(row1)
     
-    # ردیف دوم: دسترسی‌ها
-    row2 = []
-    if user_data.get("Hotline", False) and user_data.get("days_left", 0) > 0:
-        row2.append("🔑 Hotline ورود به کانال")
-    if user_data.get("CIP", False) and user_data.get("days_left", 0) > 0:
-        row2.append("🌐 ورود به کانال CIP")
-    if row2:  # فقط اگر حداقل یک گزینه وجود داشته باشد
-        keyboard.append(row2)
+    # ردیف دوم: دسترسی‌ها (دو کانال در هر ردیف)
+    mask = user_data.access_mask()
+    labels = [tier.label for tier in CHANNEL_TIERS if mask & tier.bit]
+    for i in range(0, len(labels), 2):
+        keyboard.append(labels[i:i+2])
     
     # ردیف سوم: گزینه‌های ثبت‌نام (اگر وجود داشته باشد)
     if registration_options:
@@ -362,24 +1966,27 @@ async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
     phone = normalize_phone(contact.phone_number)
     full_name = f"{update.effective_user.first_name or ''} {update.effective_user.last_name or ''}".strip()
 
-    # ذخیره اولیه اطلاعات کاربر
-    user_data = {
-        "phone": phone,
-        "name": full_name,
-        "registered_at": datetime.now(timezone.utc).isoformat(),
-        "links": {},
-        "alerts": [],
-        "watch_assets": [],
-        "CIP": False,
-        "Hotline": False,
-        "subscription_days": 0,
-        "subscription_start": "",
-        "days_left": 0,
-        "last_alert_sent": None
-    }
-    
-    # همگام‌سازی با گوگل شیت
-    user_data = await sync_user_data(user_id, user_data)
+    existing = users_data.get(user_id)
+    if existing is not None and existing.get("phone") == phone:
+        # ارسال دوباره شماره: وضعیت اشتراک موجود حفظ می‌شود و فقط نام به‌روز می‌شود
+        user_data = existing
+        user_data["name"] = full_name
+        user_data = await sync_user_data(user_id, user_data)
+    else:
+        # ذخیره اولیه اطلاعات کاربر
+        user_data = UserRecord.from_dict({
+            "phone": phone,
+            "name": full_name,
+            "registered_at": datetime.now(timezone.utc).isoformat(),
+            "alerts": [],
+            "watch_assets": [],
+            "subscription_days": 0,
+            "subscription_start": "",
+            "last_alert_sent": None
+        })
+
+        # رکورد تازه هیچ وضعیتی ندارد؛ کش شماره نباید آن را تأیید کند و مستقیماً از شیت خوانده می‌شود
+        user_data = await single_flight(("sync", user_id), lambda: _sync_user_from_sheet(user_id, user_data))
     
     # ارسال هشدار اگر اشتراک در حال اتمام است
     if user_data.get("days_left", 0) <= SUBSCRIPTION_ALERT_DAYS:
@@ -387,7 +1994,7 @@ async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # ذخیره کاربر جدید در دیتا
     users_data[user_id] = user_data
-    save_data(users_data)
+    mark_dirty(user_id)
     
     # نمایش منوی اصلی
     await show_main_menu(update.message, context, user_data)
@@ -411,34 +2018,24 @@ async def my_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⚠️ لطفاً ابتدا احراز هویت کنید (/start).")
         return
     
-    # همگام‌سازی با گوگل شیت
-    user = await sync_user_data(user_id, user)
+    # همگام‌سازی با گوگل شیت (با سقف تعداد؛ پس از آن وضعیت محلی نمایش داده می‌شود)
+    if subscription_refresh_limiter.try_acquire(user_id):
+        user = await sync_user_data(user_id, user)
     
-    if user.get("days_left", 0) > 0:
+    days_left = user.days_left
+    if days_left > 0:
         # نمایش نوع اشتراک
-        subscription_type = []
-        if user.get("CIP", False):
-            subscription_type.append("CIP")
-        if user.get("Hotline", False):
-            subscription_type.append("Hotline")
-        
-        expire_date = "نامشخص"
-        if user.get("subscription_start"):
-            try:
-                start_date = datetime.strptime(user["subscription_start"], "%Y-%m-%d").date()
-                expire_date = (start_date + timedelta(days=user["subscription_days"])).isoformat()
-            except:
-                pass
+        subscription_type = [tier.key for tier in CHANNEL_TIERS if user.get(tier.key, False)]
         
         message = (
             f"✅ اشتراک شما فعال است\n"
             f"🔹 نوع اشتراک: {', '.join(subscription_type) or 'تعریف نشده'}\n"
-            f"⏳ روزهای باقی‌مانده: {user['days_left']}\n"
-            f"📅 تاریخ انقضا: {expire_date}"
+            f"⏳ روزهای باقی‌مانده: {days_left}\n"
+            f"📅 تاریخ انقضا: {user_expiry_date(user).isoformat()}"
         )
         
         # ارسال هشدار اگر اشتراک در حال اتمام است
-        if user['days_left'] <= SUBSCRIPTION_ALERT_DAYS:
+        if days_left <= SUBSCRIPTION_ALERT_DAYS:
             await send_subscription_alert(context.bot, user_id, user)
     else:
         message = "⚠️ شما اشتراک فعالی ندارید."
@@ -463,53 +2060,67 @@ async def generate_invite_link(context, chat_id, expire_minutes=10):
         logging.error(f"خطا در ایجاد لینک دعوت: {e}")
         return None
 
-async def join_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = str(update.effective_user.id)
-    user = users_data.get(user_id)
-    
-    if not user:
-        await update.message.reply_text("⚠️ ابتدا احراز هویت کنید (/start).")
-        return
-    
-    # همگام‌سازی و بررسی دسترسی
-    user = await sync_user_data(user_id, user)
-    
-    if not user.get("Hotline", False) or user.get("days_left", 0) <= 0:
-        await update.message.reply_text("⚠️ شما دسترسی به این کانال را ندارید.")
-        return
-    
-    # محدودیت تعداد لینک‌ها
-    today = datetime.now(timezone.utc).date().isoformat()
-    links_count = user.get("links", {}).get(today, 0)
-    
-    if links_count >= MAX_LINKS_PER_DAY:
-        await update.message.reply_text("⚠️ سقف درخواست لینک در روز تمام شده است.")
-        return
-    
+# کش لینک‌های دعوت: chat_id → {user_id: (لینک، زمان انقضای monotonic)}
+# هر سطح link_minutes خودش را دارد، پس برای هر کانال dict جداگانه نگه داشته می‌شود؛ درون یک
+# کانال TTL یکسان است و ترتیب درج همان ترتیب انقضاست، پس پاک‌سازی تا اولین ورودی معتبر کافی است
+invite_link_cache = {}
+invite_link_stats = {"hit": 0, "created": 0}
+
+def _evict_expired_links(now):
+    for chat_id, links in list(invite_link_cache.items()):
+        while links:
+            user_id, (_, expires_at) = next(iter(links.items()))
+            if expires_at > now:
+                break
+            del links[user_id]
+        if not links:
+            del invite_link_cache[chat_id]
+
+def cached_invite_link(user_id, chat_id):
+    now = time.monotonic()
+    _evict_expired_links(now)
+    entry = invite_link_cache.get(chat_id, {}).get(user_id)
+    return entry[0] if entry and entry[1] > now else None
+
+def remember_invite_link(user_id, chat_id, invite_link, expire_minutes=LINK_EXPIRE_MINUTES):
+    ttl = expire_minutes * 60 - LINK_REUSE_MARGIN_SECONDS
+    links = invite_link_cache.setdefault(chat_id, {})
+    links.pop(user_id, None)
+    links[user_id] = (invite_link, time.monotonic() + ttl)
+
+async def get_or_create_invite_link(context, user_id, tier):
+    """لینک معتبر قبلی کاربر یا لینک جدید (با رعایت سیاست لینک سطح)؛ خروجی: (لینک، پیام خطا)"""
+    invite_link = cached_invite_link(user_id, tier.chat_id)
+    if invite_link:
+        # تکرار درخواست: همان لینک بدون فراخوانی API و بدون مصرف سهمیه روزانه
+        invite_link_stats["hit"] += 1
+        return invite_link, None
+
+    # چند ضربه هم‌زمان پیش از بازگشت اولین فراخوانی API: یک لینک و یک سهمیه مشترک
+    return await single_flight(
+        ("invite", user_id, tier.chat_id),
+        lambda: _create_invite_link(context, user_id, tier)
+    )
+
+async def _create_invite_link(context, user_id, tier):
+    # محدودیت تعداد لینک‌ها (پنجره لغزان ۲۴ ساعته)
+    limiter = link_limiters[tier.key]
+    if not limiter.allow(user_id):
+        minutes = int(limiter.retry_after(user_id) // 60) + 1
+        return None, f"⚠️ سقف درخواست لینک در ۲۴ ساعت گذشته تمام شده است. {minutes} دقیقه دیگر تلاش کنید."
+
     # تولید لینک
-    invite_link = await generate_invite_link(context, CHANNEL_ID, LINK_EXPIRE_MINUTES)
-    
+    invite_link = await generate_invite_link(context, tier.chat_id, tier.link_minutes)
     if not invite_link:
-        await update.message.reply_text("⚠️ خطا در ایجاد لینک. لطفاً بعداً تلاش کنید.")
-        return
-    
+        return None, "⚠️ خطا در ایجاد لینک. لطفاً بعداً تلاش کنید."
+
     # ذخیره اطلاعات
-    user["links"][today] = links_count + 1
-    users_data[user_id] = user
-    save_data(users_data)
-    
-    # ارسال لینک به صورت دکمه اینلاین
-    keyboard = [[InlineKeyboardButton("Hotlineورود به کانال", url=invite_link)]]
-    await update.message.reply_text(
-        f"🔑 لینک دسترسی به کانال (۱۰ دقیقه اعتبار):\n\n"
-        f"⚠️ توجه: این لینک فقط برای شما فعال است\n"
-        f"⚠️ پس از کلیک، درخواست عضویت شما به صورت خودکار تایید می‌شود\n"
-        f"⚠️ محدودیت: فقط {MAX_LINKS_PER_DAY} لینک در روز",
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        protect_content=True  # غیرفعال کردن فوروارد و کپی
-    )
+    invite_link_stats["created"] += 1
+    remember_invite_link(user_id, tier.chat_id, invite_link, tier.link_minutes)
+    limiter.hit(user_id)
+    return invite_link, None
 
-async def join_cip_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def join_tier_channel(update: Update, context: ContextTypes.DEFAULT_TYPE, tier):
     user_id = str(update.effective_user.id)
     user = users_data.get(user_id)
     
@@ -520,37 +2131,22 @@ async def join_cip_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # همگام‌سازی و بررسی دسترسی
     user = await sync_user_data(user_id, user)
     
-    if not user.get("CIP", False) or user.get("days_left", 0) <= 0:
+    if not user.access_mask() & tier.bit:
         await update.message.reply_text("⚠️ شما دسترسی به این کانال را ندارید.")
         return
     
-    # محدودیت تعداد لینک‌ها
-    today = datetime.now(timezone.utc).date().isoformat()
-    links_count = user.get("links", {}).get(today, 0)
-    
-    if links_count >= MAX_LINKS_PER_DAY:
-        await update.message.reply_text("⚠️ سقف درخواست لینک در روز تمام شده است.")
-        return
-    
-    # تولید لینک
-    invite_link = await generate_invite_link(context, CIP_CHANNEL_ID, LINK_EXPIRE_MINUTES)
-    
+    invite_link, error = await get_or_create_invite_link(context, user_id, tier)
     if not invite_link:
-        await update.message.reply_text("⚠️ خطا در ایجاد لینک. لطفاً بعداً تلاش کنید.")
+        await update.message.reply_text(error)
         return
     
-    # ذخیره اطلاعات
-    user["links"][today] = links_count + 1
-    users_data[user_id] = user
-    save_data(users_data)
-    
     # ارسال لینک به صورت دکمه اینلاین
-    keyboard = [[InlineKeyboardButton("ورود به کانال CIP", url=invite_link)]]
+    keyboard = [[InlineKeyboardButton(tier.button, url=invite_link)]]
     await update.message.reply_text(
-        f"🌐 لینک دسترسی به کانال CIP (۱۰ دقیقه اعتبار):\n\n"
+        f"{tier.intro} ({tier.link_minutes} دقیقه اعتبار):\n\n"
         f"⚠️ توجه: این لینک فقط برای شما فعال است\n"
         f"⚠️ پس از کلیک، درخواست عضویت شما به صورت خودکار تایید می‌شود\n"
-        f"⚠️ محدودیت: فقط {MAX_LINKS_PER_DAY} لینک در روز",
+        f"⚠️ محدودیت: فقط {tier.max_links_per_day} لینک در روز",
         reply_markup=InlineKeyboardMarkup(keyboard),
         protect_content=True  # غیرفعال کردن فوروارد و کپی
     )
@@ -558,37 +2154,46 @@ async def join_cip_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # —————————————————————————————————————————————————————————————————————
 # بخش جدید: مدیریت درخواست‌های عضویت در کانال
 # —————————————————————————————————————————————————————————————————————
+join_request_stats = {"approved": 0, "declined": 0, "revoked": 0}
+
+async def reverify_join(bot, user_id, tier):
+    """بررسی دوباره دسترسی با شیت پس از تأیید؛ در صورت نامعتبر بودن، کاربر از کانال خارج می‌شود"""
+    user = users_data.get(user_id)
+    if user is None:
+        return
+    try:
+        user = await sync_user_data(user_id, user)
+        if not user.access_mask() & tier.bit:
+            logging.warning(f"دسترسی کاربر {user_id} پس از تأیید عضویت در {tier.chat_id} نامعتبر شد؛ حذف از کانال")
+            join_request_stats["revoked"] += 1
+            await remove_from_channel(bot, tier.chat_id, int(user_id))
+    except Exception as e:
+        logging.error(f"خطا در بررسی دوباره عضویت کاربر {user_id}: {e}")
+
 async def handle_chat_join_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """مدیریت درخواست‌های عضویت در کانال"""
+    """مدیریت درخواست‌های عضویت در کانال (تصمیم از جدول دسترسی، بدون فراخوانی شیت)"""
     join_request = update.chat_join_request
     user_id = str(join_request.from_user.id)
     chat_id = join_request.chat.id
     
-    logging.info(f"دریافت درخواست عضویت: کاربر {user_id} برای کانال {chat_id}")
-    
-    # پیدا کردن کاربر در دیتابیس
-    user = users_data.get(user_id)
-    if not user:
+    # بررسی اعتبار دسترسی
+    tier = TIERS_BY_CHAT.get(chat_id)
+    valid_access = tier is not None and is_entitled(user_id, tier.bit)
+    if not valid_access and user_id not in entitlements and user_id not in users_data:
         logging.warning(f"کاربر {user_id} در دیتابیس یافت نشد")
+        join_request_stats["declined"] += 1
         await context.bot.decline_chat_join_request(chat_id, user_id)
         return
     
-    # همگام‌سازی داده‌ها
-    user = await sync_user_data(user_id, user)
-    
-    # بررسی اعتبار دسترسی
-    valid_access = False
-    if chat_id == CHANNEL_ID and user.get("Hotline", False) and user.get("days_left", 0) > 0:
-        valid_access = True
-    elif chat_id == CIP_CHANNEL_ID and user.get("CIP", False) and user.get("days_left", 0) > 0:
-        valid_access = True
-    
     # تأیید یا رد درخواست
     if valid_access:
         logging.info(f"تأیید عضویت کاربر {user_id} برای کانال {chat_id}")
+        join_request_stats["approved"] += 1
         await context.bot.approve_chat_join_request(chat_id, user_id)
+        spawn_background(reverify_join(context.bot, user_id, tier))
     else:
         logging.warning(f"رد عضویت کاربر {user_id} برای کانال {chat_id}")
+        join_request_stats["declined"] += 1
         await context.bot.decline_chat_join_request(chat_id, user_id)
         await context.bot.send_message(
             chat_id=int(user_id),
@@ -616,25 +2221,233 @@ PERIODS = {
     "شش ماه گذشته": "6m",
 }
 
-async def get_asset_data(symbol, period):
-    """تابع موقت برای دریافت داده‌های دارایی (پیاده‌سازی واقعی نیازمند اتصال به API)"""
-    # این قسمت باید با اتصال به API واقعی جایگزین شود
+# دوره → (بازه کندل، تعداد کندل‌های بسته‌شده اخیر که با هم تجمیع می‌شوند)
+PERIOD_CANDLES = {
+    "1w": ("1week", 1),
+    "1m": ("1month", 1),
+    "3m": ("1month", 3),
+    "6m": ("1month", 6),
+}
+
+PIP_SIZES = {"XAU/USD": 0.1, "USD/JPY": 0.01, "DXY": 0.01, "DJI": 1.0, "NASDAQ": 1.0}
+DEFAULT_PIP_SIZE = 0.0001
+
+class MarketDataError(Exception):
+    """پاسخ نامعتبر یا خطای ارائه‌دهنده داده بازار"""
+
+class TwelveDataProvider:
+    """ارائه‌دهنده کندل از TwelveData (endpoint time_series) روی ClientSession مشترک"""
+
+    SYMBOLS = {"NASDAQ": "IXIC"}  # نام نماد در TwelveData در صورت تفاوت با ASSETS
+
+    def __init__(self, api_key, base_url=TWELVE_API_URL):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+
+    async def time_series(self, symbols, interval, outputsize):
+        """یک فراخوانی برای چند نماد (لیست جداشده با کاما)
+
+        خروجی: symbol → لیست کندل‌ها از جدید به قدیم (تاریخ شروع، high، low، close)
+        یا MarketDataError برای نمادی که خطا داشته است.
+        """
+        provider_symbols = {self.SYMBOLS.get(symbol, symbol): symbol for symbol in symbols}
+        session = await start_http_session()
+        params = {
+            "symbol": ",".join(provider_symbols),
+            "interval": interval,
+            "outputsize": outputsize,
+            "timezone": "UTC",
+            "apikey": self.api_key,
+        }
+        market_data_stats["provider_calls"] += 1
+        market_data_stats["credits"] += len(provider_symbols)
+        async with session.get(
+            f"{self.base_url}/time_series",
+            params=params,
+            timeout=aiohttp.ClientTimeout(total=MARKET_TIMEOUT_SECONDS)
+        ) as response:
+            data = await response.json(content_type=None)
+        if not isinstance(data, dict) or data.get("status") == "error":
+            message = data.get("message") if isinstance(data, dict) else data
+            raise MarketDataError(f"{','.join(provider_symbols)} {interval}: {message}")
+        if len(provider_symbols) == 1:
+            # پاسخ تک‌نماد بدون کلید نماد برمی‌گردد
+            data = {next(iter(provider_symbols)): data}
+        return {
+            symbol: self._parse_series(data.get(provider_symbol), symbol, interval)
+            for provider_symbol, symbol in provider_symbols.items()
+        }
+
+    @staticmethod
+    def _parse_series(series, symbol, interval):
+        if not isinstance(series, dict) or series.get("status") != "ok":
+            message = series.get("message") if isinstance(series, dict) else "پاسخی دریافت نشد"
+            return MarketDataError(f"{symbol} {interval}: {message}")
+        return [
+            (date.fromisoformat(value["datetime"][:10]), float(value["high"]), float(value["low"]), float(value["close"]))
+            for value in series.get("values", [])
+        ]
+
+market_data_provider = TwelveDataProvider(TWELVE_API_KEY)
+
+def candle_start(interval, day):
+    """تاریخ شروع کندلی که day در آن قرار دارد (هفته از دوشنبه، ماه از روز اول)"""
+    if interval == "1week":
+        return day - timedelta(days=day.weekday())
+    return day.replace(day=1)
+
+def next_candle_start(interval, start):
+    if interval == "1week":
+        return start + timedelta(days=7)
+    return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+def compute_levels(high, low, close, pip):
+    """سطوح تحلیل از High/Low/Close دوره: میانه‌ها، پیوت و مقاومت/حمایت‌ها"""
+    step = (high - low) / 10
     return {
-        "H": 1800.0, "L": 1750.0, "C": 1775.0,
-        "M1": 1760.0, "M2": 1765.0, "M3": 1770.0, "M4": 1775.0,
-        "M5": 1780.0, "M6": 1785.0, "M7": 1790.0,
-        "Z1": 1775.0,
-        "pip": 0.1,
-        "U": [1800.0, 1810.0, 1820.0, 1830.0, 1840.0],
-        "D": [1750.0, 1740.0, 1730.0, 1720.0, 1710.0]
+        "H": high, "L": low, "C": close,
+        **{f"M{i}": close + (i - 4) * step for i in range(1, 8)},
+        "Z1": (high + low + close) / 3,
+        "pip": pip,
+        "U": [high + i * 2 * step for i in range(5)],
+        "D": [low - i * 2 * step for i in range(5)],
     }
 
+# هر بازه با بیشترین تعداد کندل لازم در همه دوره‌ها دریافت می‌شود (1m/3m/6m یک سری مشترک دارند)
+INTERVAL_OUTPUTSIZE = {}
+for _interval, _count in PERIOD_CANDLES.values():
+    INTERVAL_OUTPUTSIZE[_interval] = max(INTERVAL_OUTPUTSIZE.get(_interval, 0), _count + 1)
+
+class QuoteBatcher:
+    """تجمیع درخواست‌های هم‌زمان یک بازه در کمترین فراخوانی چندنمادی با رعایت سقف اعتبار در دقیقه
+
+    اعتبارها در یک پنجره لغزان ۶۰ ثانیه‌ای ثبت می‌شوند (نه سطل توکن که پر شروع می‌شود)،
+    پس اعتبار مصرف‌شده در هیچ ۶۰ ثانیه‌ای از سقف پلن بیشتر نمی‌شود؛ پنجره همراه
+    rate_limits.json ذخیره می‌شود تا راه‌اندازی مجدد هم آن را صفر نکند.
+    """
+
+    def __init__(self, provider, credits_per_minute, max_symbols, delay=MARKET_BATCH_DELAY_SECONDS):
+        self.provider = provider
+        self.credits = SlidingWindowLimiter("market_credits", credits_per_minute, 60)
+        self.max_symbols = max(1, min(max_symbols, credits_per_minute))
+        self.delay = delay
+        self._pending = {}  # interval → {symbol: future}
+        self._flushers = {}
+
+    async def fetch(self, symbol, interval):
+        pending = self._pending.setdefault(interval, {})
+        future = pending.get(symbol)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            pending[symbol] = future
+        if interval not in self._flushers:
+            self._flushers[interval] = asyncio.create_task(self._flush(interval))
+        return await asyncio.shield(future)
+
+    async def _acquire_credits(self, count):
+        while True:
+            wait = self.credits.retry_after("twelvedata", count)
+            if wait <= 0:
+                self.credits.hit("twelvedata", count=count)
+                return
+            await asyncio.sleep(wait)
+
+    async def _flush(self, interval):
+        await asyncio.sleep(self.delay)
+        pending = self._pending.pop(interval, {})
+        del self._flushers[interval]
+        symbols = list(pending)
+        for start in range(0, len(symbols), self.max_symbols):
+            chunk = symbols[start:start + self.max_symbols]
+            try:
+                await self._acquire_credits(len(chunk))
+                results = await self.provider.time_series(chunk, interval, INTERVAL_OUTPUTSIZE[interval])
+            except Exception as e:
+                results = {symbol: e for symbol in chunk}
+            for symbol in chunk:
+                result = results.get(symbol, MarketDataError(f"{symbol} {interval}: پاسخی دریافت نشد"))
+                if isinstance(result, Exception):
+                    pending[symbol].set_exception(result)
+                else:
+                    pending[symbol].set_result(result)
+
+quote_batcher = QuoteBatcher(market_data_provider, MARKET_CREDITS_PER_MINUTE, MARKET_BATCH_MAX_SYMBOLS)
+
+# کش مشترک سری‌ها: (symbol, interval) → (کندل‌ها، زمان بسته شدن کندل جاری)
+# همه کاربران و همه دوره‌های یک بازه از یک سری استفاده می‌کنند تا کندل بعدی بسته شود
+market_series_cache = {}
+market_data_stats = {"hit": 0, "miss": 0, "provider_calls": 0, "credits": 0, "errors": 0}
+
+def candle_close_timestamp(interval, day):
+    next_start = next_candle_start(interval, candle_start(interval, day))
+    return datetime(next_start.year, next_start.month, next_start.day, tzinfo=timezone.utc).timestamp()
+
+async def _load_series(symbol, interval):
+    candles = await quote_batcher.fetch(symbol, interval)
+    today = datetime.now(timezone.utc).date()
+    market_series_cache[(symbol, interval)] = (candles, candle_close_timestamp(interval, today))
+    return candles
+
+async def get_series(symbol, interval):
+    entry = market_series_cache.get((symbol, interval))
+    if entry and entry[1] > time.time():
+        market_data_stats["hit"] += 1
+        return entry[0]
+    market_data_stats["miss"] += 1
+    try:
+        return await single_flight(("market", symbol, interval), lambda: _load_series(symbol, interval))
+    except Exception as e:
+        market_data_stats["errors"] += 1
+        logging.error(f"خطا در دریافت داده بازار {symbol} ({interval}): {e}")
+        # داده دوره قبل بهتر از هیچ است
+        return entry[0] if entry else None
+
+async def get_asset_data(symbol, period):
+    """سطوح تحلیل یک دارایی برای دوره از سری مشترک؛ None در صورت خطا و نبود داده قبلی"""
+    if period not in PERIOD_CANDLES:
+        return None
+    interval, count = PERIOD_CANDLES[period]
+    candles = await get_series(symbol, interval)
+    if not candles:
+        return None
+    # کندل در حال تشکیل کنار گذاشته می‌شود؛ فقط کندل‌های بسته‌شده تجمیع می‌شوند
+    current_start = candle_start(interval, datetime.now(timezone.utc).date())
+    closed = [candle for candle in candles if candle[0] < current_start][:count]
+    if len(closed) < count:
+        logging.error(f"کندل کافی برای {symbol} ({period}) دریافت نشد")
+        return None
+    return compute_levels(
+        max(candle[1] for candle in closed),
+        min(candle[2] for candle in closed),
+        closed[0][3],
+        PIP_SIZES.get(symbol, DEFAULT_PIP_SIZE),
+    )
+
+async def refresh_market_data():
+    """دریافت همه ASSETS برای همه بازه‌ها؛ درخواست‌ها در یک فراخوانی برای هر بازه تجمیع می‌شوند"""
+    await asyncio.gather(*(
+        get_series(symbol, interval)
+        for interval in INTERVAL_OUTPUTSIZE
+        for symbol in ASSETS.values()
+    ))
+
+async def market_refresh_loop():
+    """تازه‌سازی سری‌ها کمی پس از بسته شدن هر کندل (پیش از درخواست کاربران)"""
+    while True:
+        try:
+            await refresh_market_data()
+        except Exception as e:
+            logging.error(f"خطا در تازه‌سازی داده بازار: {e}")
+        today = datetime.now(timezone.utc).date()
+        next_close = min(candle_close_timestamp(interval, today) for interval in INTERVAL_OUTPUTSIZE)
+        await asyncio.sleep(max(60, next_close - time.time() + MARKET_REFRESH_GRACE_SECONDS))
+
 async def analysis_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     user = users_data.get(user_id)
     
     # بررسی دسترسی
-    if not user or not user.get("Hotline", False) or user.get("days_left", 0) <= 0:
+    if not user or not user.has_access("Hotline"):
         await update.message.reply_text("⚠️ برای دسترسی به تحلیل بازار باید اشتراک Hotline فعال داشته باشید.")
         return
     
@@ -696,19 +2509,9 @@ async def asset_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     user = users_data.get(user_id)
     if user is not None:
-        watch_list = user.setdefault("watch_assets", [])
-        exists = any(
-            (w["symbol"] == symbol and w["period"] == period) for w in watch_list
-        )
-        if not exists:
-            watch_list.append(
-                {
-                    "symbol": symbol,
-                    "period": period,
-                    "last_processed": datetime.now(timezone.utc).isoformat(),
-                }
-            )
-            save_data(users_data)
+        if not user.has_watch(symbol, period):
+            user.add_watch(symbol, period, datetime.now(timezone.utc).isoformat())
+            mark_dirty(user_id)
 
 async def analysis_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -725,67 +2528,244 @@ async def analysis_back_to_main(update: Update, context: ContextTypes.DEFAULT_TY
 # —————————————————————————————————————————————————————————————————————
 # بخش ششم: هشدار اتمام اشتراک (با رفع مشکل)
 # —————————————————————————————————————————————————————————————————————
-async def check_subscription_alerts(app):
-    """ارسال هشدار به کاربرانی که اشتراکشان در حال اتمام است"""
-    global users_data
+# زمان‌بندی هشدارها: heap مرتب بر اساس زمان هشدار بعدی هر کاربر
+# ورودی‌های قدیمی heap حذف نمی‌شوند؛ فقط ورودی‌ای معتبر است که با alert_due کاربر یکی باشد
+alert_heap = []
+alert_due = {}  # user_id → زمان هشدار بعدی (timestamp)
+alert_wakeup = asyncio.Event()
+
+def next_alert_time(expiry, last_alert_sent=None):
+    """زمان هشدار بعدی: از SUBSCRIPTION_ALERT_DAYS روز پیش از انقضا، هر SUBSCRIPTION_ALERT_REPEAT_SECONDS؛ None یعنی هشداری لازم نیست"""
+    if not expiry:
+        return None
+    window_start = datetime(expiry.year, expiry.month, expiry.day, tzinfo=timezone.utc) - timedelta(days=SUBSCRIPTION_ALERT_DAYS)
+    window_end = window_start + timedelta(days=SUBSCRIPTION_ALERT_DAYS)
+    due = window_start
+    if last_alert_sent:
+        try:
+            due = max(due, datetime.fromisoformat(last_alert_sent) + timedelta(seconds=SUBSCRIPTION_ALERT_REPEAT_SECONDS))
+        except (TypeError, ValueError):
+            pass
+    return due.timestamp() if due < window_end else None
+
+def _set_alert_due(user_id, due):
+    if alert_due.get(user_id) == due:
+        return
+    if due is None:
+        alert_due.pop(user_id, None)
+        return
+    alert_due[user_id] = due
+    if not alert_heap or due < alert_heap[0][0]:
+        alert_wakeup.set()
+    heapq.heappush(alert_heap, (due, user_id))
+    # جلوگیری از رشد بی‌رویه heap با ورودی‌های باطل‌شده
+    if len(alert_heap) > 2 * len(alert_due) + 1024:
+        alert_heap[:] = [(due, user_id) for user_id, due in alert_due.items()]
+        heapq.heapify(alert_heap)
+
+def schedule_user_alert(user_id):
+    """به‌روزرسانی زمان هشدار یک کاربر پس از هر تغییر (ویرایش ادمین، همگام‌سازی، ارسال هشدار)"""
+    user = users_data.get(user_id)
+    if user is None or not user.flags:
+        _set_alert_due(user_id, None)
+        return
+    _set_alert_due(user_id, next_alert_time(user_expiry_date(user), user.get("last_alert_sent")))
+
+def build_alert_schedule():
+    """ساخت اولیه زمان‌بندی از ایندکس انقضا؛ فقط کاربرانی که در بازه هشدار هستند decode می‌شوند"""
+    flush_dirty_users()
+    alert_heap.clear()
+    alert_due.clear()
+    today = datetime.now(timezone.utc).date()
+    window_open_until = today + timedelta(days=SUBSCRIPTION_ALERT_DAYS)
+    for user_id, expiry in user_repo.expiring_between(today + timedelta(days=1), date.max):
+        if expiry <= window_open_until:
+            schedule_user_alert(user_id)
+        else:
+            # بازه هشدار هنوز باز نشده؛ نوع اشتراک هنگام سررسید بررسی می‌شود
+            _set_alert_due(user_id, next_alert_time(expiry))
+    logging.info(f"🗓 زمان‌بندی هشدار اشتراک برای {len(alert_due)} کاربر ساخته شد")
+
+def pop_due_alerts(now_ts):
+    """برداشتن کاربرانی که زمان هشدارشان رسیده است"""
+    due_users = []
+    while alert_heap and alert_heap[0][0] <= now_ts:
+        due, user_id = heapq.heappop(alert_heap)
+        if alert_due.get(user_id) == due:
+            del alert_due[user_id]
+            due_users.append(user_id)
+    return due_users
+
+async def send_due_subscription_alerts(app):
+    """ارسال هشدار به کاربرانی که زمان هشدارشان رسیده است (هزینه متناسب با تعداد سررسیدها)"""
     now = datetime.now(timezone.utc)
-    logging.info(f"🔔 شروع بررسی هشدارهای اشتراک در {now}")
-    
-    for user_id, user in users_data.items():
-        days_left = user.get("days_left", 0)
-        last_alert = user.get("last_alert_sent")
+    today = now.date()
+    messages = []
+    due_users = pop_due_alerts(now.timestamp())
+    for user_id in due_users:
+        user = users_data.get(user_id)
+        expiry = user_expiry_date(user)
+        # ممکن است از زمان زمان‌بندی تغییر کرده باشد؛ دوباره محاسبه می‌شود
+        due = next_alert_time(expiry, user.get("last_alert_sent")) if expiry else None
+        if due is None or due > now.timestamp():
+            schedule_user_alert(user_id)
+            continue
+        days_left = (expiry - today).days
+
+        # تشخیص نوع اشتراک
+        subscription_types = [tier.key for tier in CHANNEL_TIERS if user.get(tier.key, False)]
         
-        # شرایط ارسال هشدار:
-        if days_left > 0 and days_left <= SUBSCRIPTION_ALERT_DAYS:
-            logging.info(f"کاربر {user_id} واجد شرایط هشدار: {days_left} روز باقی مانده")
+        if not subscription_types:
+            logging.warning(f"کاربر {user_id} اشتراک فعال دارد اما نوع اشتراک تعریف نشده است")
+            continue
             
-            # بررسی زمان آخرین هشدار
-            if last_alert:
-                try:
-                    last_alert_time = datetime.fromisoformat(last_alert)
-                    if (now - last_alert_time) < timedelta(hours=3):
-                        logging.info(f"اخیراً به کاربر {user_id} هشدار ارسال شده است. رد شد.")
-                        continue
-                except Exception as e:
-                    logging.error(f"خطا در بررسی زمان هشدار برای {user_id}: {e}")
-            
-            # تشخیص نوع اشتراک
-            subscription_types = []
-            if user.get("CIP", False):
-                subscription_types.append("CIP")
-            if user.get("Hotline", False):
-                subscription_types.append("Hotline")
-            
-            if not subscription_types:
-                logging.warning(f"کاربر {user_id} اشتراک فعال دارد اما نوع اشتراک تعریف نشده است")
+        # ساخت پیام با ذکر نوع اشتراک
+        subscription_names = " و ".join(subscription_types)
+        message = (
+            f"⏳ از زمان اشتراک شما برای {subscription_names} فقط {days_left} روز باقی مانده است!\n"
+            f"⚠️ لطفاً جهت جلوگیری از حذف دسترسی به کانال‌ها اشتراک خود را تمدید کنید.\n\n"
+            f"📞 برای تمدید اشتراک با پشتیبانی تماس بگیرید: {SUPPORT_ID}"
+        )
+        
+        messages.append((int(user_id), {"text": message, "protect_content": True}))
+
+    if not messages:
+        return
+    results = await Broadcaster(app.bot).broadcast(messages)
+    sent = 0
+    for chat_id, (status, error) in results.items():
+        if status == "sent":
+            sent += 1
+        else:
+            logging.error(f"خطا در ارسال هشدار اشتراک به {chat_id}: {status} {error}")
+        # ثبت زمان آخرین تلاش؛ mark_dirty هشدار بعدی را زمان‌بندی می‌کند
+        user = users_data.get(str(chat_id))
+        if user is not None:
+            user["last_alert_sent"] = now.isoformat()
+            mark_dirty(str(chat_id))
+
+    logging.info(f"✅ {sent} هشدار اشتراک از {len(messages)} ارسال شد")
+
+async def subscription_alert_loop(app):
+    """خواب تا سررسید نزدیک‌ترین هشدار یا تا زمان‌بندی یک هشدار زودتر"""
+    build_alert_schedule()
+    while True:
+        alert_wakeup.clear()
+        try:
+            await send_due_subscription_alerts(app)
+        except Exception as e:
+            logging.error(f"خطا در حلقه هشدار اشتراک: {e}")
+        timeout = SUBSCRIPTION_ALERT_REPEAT_SECONDS
+        if alert_heap:
+            timeout = min(timeout, max(0, alert_heap[0][0] - time.time()))
+        try:
+            await asyncio.wait_for(alert_wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+# —————————————————————————————————————————————————————————————————————
+# حذف خودکار کاربران منقضی‌شده از کانال‌ها
+# —————————————————————————————————————————————————————————————————————
+# checkpoint: user_id → ordinal انقضایی که کاربر بابت آن حذف شده است؛ پس از تمدید و
+# انقضای دوباره، ordinal تغییر می‌کند و کاربر دوباره بررسی می‌شود
+removal_stats = {"runs": 0, "removed": 0, "skipped_valid": 0, "failed": 0, "dry_run": 0, "last_run": None}
+
+def load_removal_checkpoint():
+    if os.path.exists(REMOVAL_CHECKPOINT_FILE):
+        try:
+            with open(REMOVAL_CHECKPOINT_FILE, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            logging.error(f"خطا در بارگیری checkpoint حذف کاربران: {e}")
+    return {}
+
+def save_removal_checkpoint(checkpoint):
+    tmp_file = REMOVAL_CHECKPOINT_FILE + ".tmp"
+    try:
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(checkpoint, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, REMOVAL_CHECKPOINT_FILE)
+    except Exception as e:
+        logging.error(f"خطا در ذخیره checkpoint حذف کاربران: {e}")
+
+def lapsed_channels(user):
+    """کانال‌هایی که کاربر قبلاً به آن‌ها دسترسی داشته و اکنون ندارد"""
+    return [
+        tier.chat_id for tier in CHANNEL_TIERS
+        if tier.chat_id and user.flags & tier.bit and not user.access_mask() & tier.bit
+    ]
+
+async def remove_from_channel(bot, chat_id, user_id):
+    """ban و بلافاصله unban: کاربر خارج می‌شود ولی پس از تمدید می‌تواند دوباره عضو شود"""
+    await telegram_send_bucket.acquire()
+    try:
+        await bot.ban_chat_member(chat_id=chat_id, user_id=user_id)
+    except BadRequest as e:
+        # کاربر عضو کانال نیست یا حساب حذف شده است
+        logging.info(f"حذف {user_id} از {chat_id} لازم نبود: {e}")
+        return
+    except RetryAfter as e:
+        telegram_send_bucket.pause(float(e.retry_after))
+        raise
+    await telegram_send_bucket.acquire()
+    await bot.unban_chat_member(chat_id=chat_id, user_id=user_id, only_if_banned=True)
+
+async def remove_expired_members(bot, dry_run=REMOVAL_DRY_RUN):
+    """حذف کاربران منقضی‌شده در دسته‌های محدود؛ پیشرفت پس از هر دسته ذخیره می‌شود"""
+    removal_stats["runs"] += 1
+    flush_dirty_users()
+    today = date.fromordinal(today_ordinal())
+    checkpoint = load_removal_checkpoint()
+    expired = {user_id: expiry.toordinal() for user_id, expiry in user_repo.expiring_between(date.min, today)}
+    # کاربرانی که تمدید کرده‌اند از checkpoint خارج می‌شوند
+    checkpoint = {user_id: expiry for user_id, expiry in checkpoint.items() if expired.get(user_id) == expiry}
+    pending = [user_id for user_id in expired if user_id not in checkpoint]
+    logging.info(f"🧹 حذف کاربران منقضی: {len(pending)} کاربر در انتظار ({'آزمایشی' if dry_run else 'واقعی'})")
+
+    for start in range(0, len(pending), REMOVAL_BATCH_SIZE):
+        for user_id in pending[start:start + REMOVAL_BATCH_SIZE]:
+            user = users_data.get(user_id)
+            if user is None:
+                continue
+            if lapsed_channels(user):
+                # پیش از حذف، وضعیت از شیت تازه می‌شود تا تمدید ثبت‌نشده باعث حذف نشود
+                user = await sync_user_data(user_id, user)
+            channels = lapsed_channels(user)
+            if not channels:
+                removal_stats["skipped_valid"] += 1
+                if user.expires_on and user.expires_on <= today.toordinal():
+                    checkpoint[user_id] = user.expires_on
+                continue
+            if dry_run:
+                removal_stats["dry_run"] += 1
+                logging.info(f"[آزمایشی] کاربر {user_id} از کانال‌های {channels} حذف می‌شد")
                 continue
-                
-            # ساخت پیام با ذکر نوع اشتراک
-            subscription_names = " و ".join(subscription_types)
-            message = (
-                f"⏳ از زمان اشتراک شما برای {subscription_names} فقط {days_left} روز باقی مانده است!\n"
-                f"⚠️ لطفاً جهت جلوگیری از حذف دسترسی به کانال‌ها اشتراک خود را تمدید کنید.\n\n"
-                f"📞 برای تمدید اشتراک با پشتیبانی تماس بگیرید: {SUPPORT_ID}"
-            )
-            
             try:
-                logging.info(f"ارسال هشدار اشتراک به {user_id}")
-                await app.bot.send_message(
-                    chat_id=int(user_id),
-                    text=message,
-                    protect_content=True
-                )
-                
-                # به‌روزرسانی زمان آخرین هشدار
-                user["last_alert_sent"] = now.isoformat()
-                save_data(users_data)
-                
+                for chat_id in channels:
+                    await remove_from_channel(bot, chat_id, int(user_id))
             except Exception as e:
-                logging.error(f"خطا در ارسال هشدار اشتراک به {user_id}: {e}")
-        else:
-            logging.info(f"کاربر {user_id} واجد شرایط هشدار نیست: {days_left} روز باقی مانده")
-    
-    logging.info(f"✅ بررسی هشدارهای اشتراک تکمیل شد")
+                removal_stats["failed"] += 1
+                logging.error(f"خطا در حذف کاربر {user_id} از کانال: {e}")
+                continue
+            removal_stats["removed"] += 1
+            checkpoint[user_id] = user.expires_on
+            logging.info(f"کاربر {user_id} از کانال‌های {channels} حذف شد")
+        if not dry_run:
+            save_removal_checkpoint(checkpoint)
+        await asyncio.sleep(REMOVAL_BATCH_PAUSE_SECONDS)
+
+    removal_stats["last_run"] = datetime.now(timezone.utc).isoformat()
+
+async def member_removal_loop(bot):
+    await asyncio.sleep(60)
+    while True:
+        try:
+            await remove_expired_members(bot)
+        except Exception as e:
+            logging.error(f"خطا در حلقه حذف کاربران منقضی: {e}")
+        await asyncio.sleep(REMOVAL_INTERVAL_SECONDS)
 
 # —————————————————————————————————————————————————————————————————————
 # بخش هفتم: پنل مدیریت ادمین (با قابلیت مدیریت کدهای تخفیف)
@@ -811,6 +2791,7 @@ async def show_admin_dashboard(update: Update, context: ContextTypes.DEFAULT_TYP
         ["👥 لیست کاربران", "✏️ ویرایش اشتراک"],
         ["✏️ ویرایش کدهای تخفیف", "🔄 همگام‌سازی داده‌ها"],
         ["🔤 مدیریت کلمات کلیدی", "📝 مدیریت ثبت‌نام"],
+        ["📊 آمار ثبت‌نام", "📤 صف ارسال شیت"],
         ["🔙 بازگشت به منو"]
     ]
     await update.message.reply_text(
@@ -828,15 +2809,14 @@ async def list_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
         phone = data.get("phone", "نامشخص")
         name = data.get("name", "بدون نام")
         days_left = data.get("days_left", 0)
-        cip = "✅" if data.get("CIP", False) else "❌"
-        hotline = "✅" if data.get("Hotline", False) else "❌"
+        tiers = " | ".join(f"{tier.key}: {'✅' if data.get(tier.key, False) else '❌'}" for tier in CHANNEL_TIERS)
         
         message += (
             f"🆔 ID: {user_id}\n"
             f"📱: {phone}\n"
             f"👤: {name}\n"
             f"⏳: {days_left} روز\n"
-            f"CIP: {cip} | Hotline: {hotline}\n"
+            f"{tiers}\n"
             f"───────────────────\n"
         )
     
@@ -856,22 +2836,17 @@ async def handle_user_selection(update: Update, context: ContextTypes.DEFAULT_TY
     phone = normalize_phone(update.message.text)
     context.user_data["edit_user_phone"] = phone
     
-    # پیدا کردن کاربر
-    user_found = False
-    for user_id, data in users_data.items():
-        if data.get("phone") == phone:
-            context.user_data["edit_user_id"] = user_id
-            user_found = True
-            break
-    
-    if not user_found:
+    # پیدا کردن کاربر از طریق ایندکس شماره تلفن
+    user_id = find_user_id_by_phone(phone)
+    if user_id in users_data:
+        context.user_data["edit_user_id"] = user_id
+    else:
         await update.message.reply_text("❌ کاربر یافت نشد. لطفاً شماره صحیح وارد کنید.")
         return SELECT_USER
     
     keyboard = [
         ["📅 افزایش روز اشتراک", "🔄 تنظیم تاریخ شروع"],
-        ["🔛 فعال‌سازی CIP", "📡 فعال‌سازی Hotline"],
-        ["🔘 غیرفعال‌سازی CIP", "📴 غیرفعال‌سازی Hotline"],
+        *([tier.enable_label, tier.disable_label] for tier in CHANNEL_TIERS),
         ["🔙 بازگشت"]
     ]
     
@@ -905,36 +2880,17 @@ async def handle_subscription_edit(update: Update, context: ContextTypes.DEFAULT
         context.user_data["edit_action"] = "set_start_date"
         return EDIT_SUBSCRIPTION
     
-    elif action == "🔛 فعال‌سازی CIP":
-        user["CIP"] = True
-        await update_user_in_sheet(user)
-        users_data[user_id] = user
-        save_data(users_data)
-        await update.message.reply_text("✅ دسترسی CIP فعال شد")
-        return await show_admin_dashboard(update, context)
-    
-    elif action == "📡 فعال‌سازی Hotline":
-        user["Hotline"] = True
-        await update_user_in_sheet(user)
-        users_data[user_id] = user
-        save_data(users_data)
-        await update.message.reply_text("✅ دسترسی Hotline فعال شد")
-        return await show_admin_dashboard(update, context)
-    
-    elif action == "🔘 غیرفعال‌سازی CIP":
-        user["CIP"] = False
-        await update_user_in_sheet(user)
-        users_data[user_id] = user
-        save_data(users_data)
-        await update.message.reply_text("❌ دسترسی CIP غیرفعال شد")
-        return await show_admin_dashboard(update, context)
-    
-    elif action == "📴 غیرفعال‌سازی Hotline":
-        user["Hotline"] = False
+    elif action in TIER_ADMIN_ACTIONS:
+        tier, enabled = TIER_ADMIN_ACTIONS[action]
+        user[tier.key] = enabled
         await update_user_in_sheet(user)
         users_data[user_id] = user
-        save_data(users_data)
-        await update.message.reply_text("❌ دسترسی Hotline غیرفعال شد")
+        mark_dirty(user_id)
+        invalidate_entitlement(user.get("phone"))
+        if enabled:
+            await update.message.reply_text(f"✅ دسترسی {tier.key} فعال شد")
+        else:
+            await update.message.reply_text(f"❌ دسترسی {tier.key} غیرفعال شد")
         return await show_admin_dashboard(update, context)
     
     elif action == "🔙 بازگشت":
@@ -957,17 +2913,11 @@ async def handle_edit_value(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if action == "add_days":
         try:
             days = int(value)
-            if not user.get("subscription_start") or user.get("days_left", 0) <= 0:
-                user["subscription_start"] = datetime.now(timezone.utc).date().isoformat()
+            if not user.get("subscription_start") or user.days_left <= 0:
+                user["subscription_start"] = date.fromordinal(today_ordinal()).isoformat()
             
             user["subscription_days"] = max(0, user.get("subscription_days", 0) + days)
             
-            # محاسبه days_left
-            start_date = datetime.strptime(user["subscription_start"], "%Y-%m-%d").date()
-            today = datetime.now(timezone.utc).date()
-            days_passed = (today - start_date).days
-            user["days_left"] = max(0, user["subscription_days"] - days_passed)
-            
             # ریست کردن هشدارهای ارسال شده
             user["last_alert_sent"] = None
             
@@ -977,14 +2927,9 @@ async def handle_edit_value(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     elif action == "set_start_date":
         try:
-            datetime.strptime(value, "%Y-%m-%d")
+            value = datetime.strptime(value, "%Y-%m-%d").date().isoformat()
             user["subscription_start"] = value
             
-            start_date = datetime.strptime(value, "%Y-%m-%d").date()
-            today = datetime.now(timezone.utc).date()
-            days_passed = (today - start_date).days
-            user["days_left"] = max(0, user.get("subscription_days", 0) - days_passed)
-            
             user["last_alert_sent"] = None
             
             await update.message.reply_text(f"✅ تاریخ شروع اشتراک به {value} تنظیم شد")
@@ -993,7 +2938,8 @@ async def handle_edit_value(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update_user_in_sheet(user)
     users_data[user_id] = user
-    save_data(users_data)
+    mark_dirty(user_id)
+    invalidate_entitlement(user.get("phone"))
     return await show_admin_dashboard(update, context)
 
 async def edit_discount_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1036,10 +2982,10 @@ async def handle_discount_value(update: Update, context: ContextTypes.DEFAULT_TY
     forbidden_commands = [
         "👥 لیست کاربران", "✏️ ویرایش اشتراک", "✏️ ویرایش کدهای تخفیف",
         "🔄 همگام‌سازی داده‌ها", "🔙 بازگشت به منو", "📅 افزایش روز اشتراک",
-        "🔄 تنظیم تاریخ شروع", "🔛 فعال‌سازی CIP", "📡 فعال‌سازی Hotline",
-        "🔘 غیرفعال‌سازی CIP", "📴 غیرفعال‌سازی Hotline", "🔙 بازگشت",
+        "🔄 تنظیم تاریخ شروع", "🔙 بازگشت",
         "✏️ ویرایش کد 10%", "✏️ ویرایش کد 20%", "🔤 مدیریت کلمات کلیدی",
-        "📝 مدیریت ثبت‌نام"
+        "📝 مدیریت ثبت‌نام", "📊 آمار ثبت‌نام", "📤 صف ارسال شیت",
+        *TIER_ADMIN_ACTIONS
     ]
     
     if new_code in forbidden_commands:
@@ -1055,12 +3001,122 @@ async def handle_discount_value(update: Update, context: ContextTypes.DEFAULT_TY
     
     return await show_admin_dashboard(update, context)
 
+async def _push_chunk(payloads, state):
+    """ارسال یک دسته کاربر؛ اگر Apps Script ارسال دسته‌ای را نپذیرد، تک‌تک و هم‌زمان ارسال می‌شوند"""
+    if state["bulk_supported"]:
+        try:
+            status, text = await sheet_request(
+                "POST",
+                GOOGLE_SHEET_URL,
+                payload={"action": "bulk_register", "rows": payloads},
+                timeout=SHEET_BULK_TIMEOUT_SECONDS,
+                latency_sensitive=False
+            )
+            if status == 200:
+                result = json.loads(text)
+                if isinstance(result, dict) and result.get("status") == "ok":
+                    failed = list(result.get("failed", []))
+                    return len(payloads) - len(failed), failed
+                # پاسخ نامعتبر یعنی اسکریپت action=bulk_register را نمی‌شناسد
+                state["bulk_supported"] = False
+                logging.warning("Apps Script ارسال دسته‌ای را پشتیبانی نمی‌کند؛ ارسال تکی")
+            else:
+                logging.error(f"خطا در ارسال دسته‌ای به گوگل شیت: {status}")
+        except Exception as e:
+            logging.error(f"خطا در ارسال دسته‌ای به گوگل شیت: {e}")
+
+    results = await asyncio.gather(*(_post_user_payload(payload) for payload in payloads))
+    failed = [payload["phone"] for payload, ok in zip(payloads, results) if not ok]
+    return len(payloads) - len(failed), failed
+
+async def bulk_push_users(items, state):
+    """ارسال همه کاربران در دسته‌های SHEET_BULK_CHUNK_SIZE تایی با حداکثر SHEET_BULK_PARALLEL دسته هم‌زمان"""
+    chunks = [items[i:i + SHEET_BULK_CHUNK_SIZE] for i in range(0, len(items), SHEET_BULK_CHUNK_SIZE)]
+    semaphore = asyncio.Semaphore(SHEET_BULK_PARALLEL)
+
+    async def run_chunk(chunk):
+        payloads = [build_sheet_payload(user) for _, user in chunk]
+        async with semaphore:
+            ok, failed = await _push_chunk(payloads, state)
+        failed_phones = set(failed)
+        for (user_id, user), payload in zip(chunk, payloads):
+            if payload["phone"] in failed_phones:
+                enqueue_sheet_write("user", payload, save=False)
+            else:
+                user["sheet_hash"] = sheet_payload_hash(payload)
+                mark_dirty(user_id)
+        if failed_phones:
+            save_outbox()
+            outbox_event.set()
+        state["done"] += len(chunk)
+        state["ok"] += ok
+        state["failed"].extend(failed)
+
+    await asyncio.gather(*(run_chunk(chunk) for chunk in chunks))
+
+bulk_sync_running = False
+
+async def _run_bulk_sync(bot, chat_id, items):
+    global bulk_sync_running
+    started = time.monotonic()
+    state = {"total": len(items), "done": 0, "ok": 0, "failed": [], "bulk_supported": True}
+    push = asyncio.create_task(bulk_push_users(items, state))
+    try:
+        # گزارش دوره‌ای پیشرفت به ادمین
+        while not push.done():
+            await asyncio.wait([push], timeout=SYNC_PROGRESS_INTERVAL_SECONDS)
+            if not push.done():
+                await bot.send_message(
+                    chat_id=chat_id,
+                    text=f"⏳ همگام‌سازی: {state['done']} از {state['total']} کاربر ({len(state['failed'])} خطا)"
+                )
+        push.result()
+    except Exception as e:
+        logging.error(f"خطا در همگام‌سازی گروهی: {e}")
+    finally:
+        bulk_sync_running = False
+
+    elapsed = time.monotonic() - started
+    message = (
+        f"✅ همگام‌سازی با گوگل شیت پایان یافت\n"
+        f"🔹 موفق: {state['ok']}\n"
+        f"🔸 ناموفق: {len(state['failed'])}\n"
+        f"⏱ زمان: {elapsed:.1f} ثانیه"
+    )
+    if state["failed"]:
+        message += "\n\nشماره‌های ناموفق:\n" + "\n".join(state["failed"][:20])
+        if len(state["failed"]) > 20:
+            message += f"\n... و {len(state['failed']) - 20} مورد دیگر"
+    await bot.send_message(chat_id=chat_id, text=message)
+
 async def sync_all_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    count = 0
-    for user_id, user_data in users_data.items():
-        if await update_user_in_sheet(user_data):
-            count += 1
-    await update.message.reply_text(f"✅ {count} کاربر با گوگل شیت همگام‌سازی شدند")
+    global bulk_sync_running
+    if bulk_sync_running:
+        await update.message.reply_text("⏳ همگام‌سازی قبلی هنوز در حال اجراست.")
+        return ADMIN_ACTION
+    
+    items = list(users_data.items())
+    bulk_sync_running = True
+    await update.message.reply_text(f"⏳ همگام‌سازی {len(items)} کاربر با گوگل شیت شروع شد...")
+    # اجرا در پس‌زمینه تا ربات در این مدت به بقیه کاربران پاسخ دهد
+    spawn_background(_run_bulk_sync(context.bot, update.effective_chat.id, items))
+    return ADMIN_ACTION
+
+async def show_outbox_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """نمایش وضعیت صف ارسال‌های معوق به گوگل شیت"""
+    status = outbox_status()
+    if not status["depth"]:
+        await update.message.reply_text("📤 صف ارسال شیت خالی است.")
+        return ADMIN_ACTION
+    
+    oldest = timedelta(seconds=status["oldest_age_seconds"])
+    message = (
+        f"📤 صف ارسال شیت\n\n"
+        f"🔹 تعداد در صف: {status['depth']}\n"
+        f"🔸 کاربران: {status['by_kind'].get('user', 0)} | ثبت‌نام‌ها: {status['by_kind'].get('reg', 0)}\n"
+        f"⏳ قدیمی‌ترین مورد: {oldest}"
+    )
+    await update.message.reply_text(message)
     return ADMIN_ACTION
 
 # —————————————————————————————————————————————————————————————————————
@@ -1294,6 +3350,25 @@ async def handle_registration_option_input(update: Update, context: ContextTypes
     
     return EDIT_REGISTRATION_OPTIONS
 
+async def registration_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """نمایش آمار ثبت‌نام‌ها از روی ایندکس (بدون خواندن فایل ثبت‌نام‌ها)"""
+    if not registration_index["total"]:
+        await update.message.reply_text("📊 هنوز هیچ ثبت‌نامی انجام نشده است.")
+        return ADMIN_ACTION
+    
+    message = (
+        f"📊 آمار ثبت‌نام‌ها\n\n"
+        f"🔹 تعداد کل: {registration_index['total']}\n"
+        f"👥 تعداد کاربران: {len(registration_index['by_user'])}\n\n"
+    )
+    by_option = sorted(registration_index["by_option"].items(), key=lambda item: item[1], reverse=True)
+    for option, count in by_option:
+        message += f"▫️ {option}: {count}\n"
+    
+    for i in range(0, len(message), 4000):
+        await update.message.reply_text(message[i:i+4000])
+    return ADMIN_ACTION
+
 # —————————————————————————————————————————————————————————————————————
 # بخش جدید: پردازش ثبت‌نام کاربران
 # —————————————————————————————————————————————————————————————————————
@@ -1328,7 +3403,7 @@ async def handle_registration(update: Update, context: ContextTypes.DEFAULT_TYPE
         if success:
             await update.message.reply_text("✅ ثبت‌نام شما با موفقیت انجام شد.")
         else:
-            await update.message.reply_text("⚠️ ثبت‌نام شما ذخیره شد اما ارسال به گوگل شیت با مشکل مواجه شد.")
+            await update.message.reply_text("✅ ثبت‌نام شما ذخیره شد و به‌زودی به‌صورت خودکار ارسال می‌شود.")
     else:
         await update.message.reply_text("❌ خطا در ثبت‌نام. لطفاً با پشتیبانی تماس بگیرید.")
 
@@ -1463,10 +3538,8 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if text == "📅 اشتراک من":
         await my_subscription(update, context)
-    elif text == "🔑 Hotline ورود به کانال":
-        await join_channel(update, context)
-    elif text == "🌐 ورود به کانال CIP":
-        await join_cip_channel(update, context)
+    elif text in TIERS_BY_LABEL:
+        await join_tier_channel(update, context, TIERS_BY_LABEL[text])
     elif text == "💳 خرید اشتراک":
         await buy_subscription(update, context)
     elif text == "🛟 پشتیبانی":
@@ -1493,15 +3566,112 @@ async def handle_root(request):
 async def health_check(request):
     return web.Response(text="OK", status=200)
 
+# —————————————————————————————————————————————————————————————————————
+# دریافت تغییرات از Apps Script (push) به‌جای پرس‌وجوی دوره‌ای
+# —————————————————————————————————————————————————————————————————————
+push_idempotency_keys = OrderedDict()  # کلیدهای پردازش‌شده اخیر → پاسخ داده‌شده
+sheet_push_stats = {"requests": 0, "rejected": 0, "applied": 0, "duplicates": 0, "unknown": 0}
+
+def _remember_push_key(key, result):
+    push_idempotency_keys[key] = result
+    push_idempotency_keys.move_to_end(key)
+    while len(push_idempotency_keys) > PUSH_IDEMPOTENCY_CACHE_SIZE:
+        push_idempotency_keys.popitem(last=False)
+
+def apply_pushed_rows(rows):
+    """اعمال ردیف‌های ارسالی Apps Script روی کاربران محلی"""
+    result = {"applied": 0, "unchanged": 0, "duplicates": 0, "unknown": 0}
+    flush_dirty_users()
+    for row in rows:
+        key = row.get("id")
+        if key is not None and f"row:{key}" in push_idempotency_keys:
+            result["duplicates"] += 1
+            continue
+        phone = normalize_phone(str(row.get("phone", "")))
+        user_id = user_repo.find_by_phone(phone) if phone else None
+        user = users_data.get(user_id) if user_id else None
+        if user is None:
+            result["unknown"] += 1
+        else:
+            if apply_sheet_row(user, row, partial=True):
+                mark_dirty(user_id)
+                result["applied"] += 1
+            else:
+                result["unchanged"] += 1
+            mark_entitlement_fresh(phone)
+        if key is not None:
+            _remember_push_key(f"row:{key}", True)
+    return result
+
+async def handle_sheet_push(request):
+    """POST /sheet/push — یک ردیف یا {"rows": [...]} از Apps Script پس از ویرایش ادمین"""
+    sheet_push_stats["requests"] += 1
+    try:
+        body = await request.json()
+    except Exception:
+        return web.json_response({"status": "error", "error": "invalid json"}, status=400)
+    if not isinstance(body, dict):
+        return web.json_response({"status": "error", "error": "invalid body"}, status=400)
+
+    token = request.headers.get("X-Sheet-Token") or body.get("token") or ""
+    if not SHEET_PUSH_SECRET or not hmac.compare_digest(str(token), SHEET_PUSH_SECRET):
+        sheet_push_stats["rejected"] += 1
+        return web.json_response({"status": "error", "error": "unauthorized"}, status=403)
+
+    request_key = request.headers.get("Idempotency-Key") or body.get("idempotency_key")
+    if request_key and f"request:{request_key}" in push_idempotency_keys:
+        sheet_push_stats["duplicates"] += 1
+        cached = push_idempotency_keys[f"request:{request_key}"]
+        return web.json_response(dict(cached, duplicate=True))
+
+    rows = body.get("rows")
+    if rows is None:
+        rows = [body]
+    if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+        return web.json_response({"status": "error", "error": "invalid rows"}, status=400)
+
+    result = apply_pushed_rows(rows)
+    for field in ("applied", "duplicates", "unknown"):
+        sheet_push_stats[field] += result[field]
+    result["status"] = "ok"
+    if request_key:
+        _remember_push_key(f"request:{request_key}", result)
+    logging.info(f"📥 دریافت تغییرات از شیت: {result}")
+    return web.json_response(result)
+
+def collect_metrics():
+    """شمارنده‌های داخلی برای تنظیم پارامترها"""
+    return {
+        "users": len(users_data),
+        "entitlement_cache": dict(entitlement_cache_stats, size=len(entitlement_cache)),
+        "single_flight": dict(single_flight_stats, in_flight=len(_inflight)),
+        "sheet_mirror": sheet_mirror_stats,
+        "sheet_outbox": outbox_status(),
+        "sheet_breaker": sheet_breaker.snapshot(),
+        "sheet_writes": sheet_write_stats,
+        "sheet_push": sheet_push_stats,
+        "broadcast": broadcast_stats,
+        "member_removal": removal_stats,
+        "invite_links": dict(invite_link_stats, cached=sum(len(links) for links in invite_link_cache.values())),
+        "join_requests": dict(join_request_stats, entitlements=len(entitlements)),
+        "market_data": dict(market_data_stats, cached=len(market_series_cache)),
+    }
+
+async def metrics(request):
+    return web.json_response(collect_metrics())
+
 async def run_webserver():
     app_http = web.Application()
     app_http.router.add_get("/", handle_root)
     app_http.router.add_get("/health", health_check)
+    app_http.router.add_get("/metrics", metrics)
+    app_http.router.add_post("/sheet/push", handle_sheet_push)
     runner = web.AppRunner(app_http)
     await runner.setup()
     site = web.TCPSite(runner, "0.0.0.0", PORT)
     await site.start()
     logging.info(f"🌐 Web server listening on port {PORT}")
+    return runner
 
 # اجرای اصلی
 async def main():
@@ -1511,7 +3681,8 @@ async def main():
     )
     logging.info("🚀 Starting bot...")
 
-    asyncio.create_task(run_webserver())
+    await start_http_session()
+    web_task = asyncio.create_task(run_webserver())
 
     app = ApplicationBuilder().token(BOT_TOKEN).build()
 
@@ -1527,11 +3698,15 @@ async def main():
                 MessageHandler(filters.Regex("^🔄 همگام‌سازی داده‌ها$"), sync_all_data),
                 MessageHandler(filters.Regex("^🔤 مدیریت کلمات کلیدی$"), edit_keywords_start),
                 MessageHandler(filters.Regex("^📝 مدیریت ثبت‌نام$"), edit_registration_options_start),
+                MessageHandler(filters.Regex("^📊 آمار ثبت‌نام$"), registration_stats),
+                MessageHandler(filters.Regex("^📤 صف ارسال شیت$"), show_outbox_status),
                 MessageHandler(filters.Regex("^🔙 بازگشت به منو$"), admin_logout),
             ],
             SELECT_USER: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_user_selection)],
             EDIT_SUBSCRIPTION: [
-                MessageHandler(filters.Regex("^(📅 افزایش روز اشتراک|🔄 تنظیم تاریخ شروع|🔛 فعال‌سازی CIP|📡 فعال‌سازی Hotline|🔘 غیرفعال‌سازی CIP|📴 غیرفعال‌سازی Hotline|🔙 بازگشت)$"), handle_subscription_edit),
+                MessageHandler(filters.Regex(
+                    "^(" + "|".join(re.escape(label) for label in ["📅 افزایش روز اشتراک", "🔄 تنظیم تاریخ شروع", *TIER_ADMIN_ACTIONS, "🔙 بازگشت"]) + ")$"
+                ), handle_subscription_edit),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, handle_edit_value)
             ],
             EDIT_DISCOUNT: [
@@ -1580,18 +3755,67 @@ async def main():
                 logging.error(f"خطا در حلقه هشدار قیمت: {e}")
             await asyncio.sleep(ALERT_INTERVAL_SECONDS)
     
-    async def subscription_alert_loop():
-        await asyncio.sleep(30)
+    async def store_compaction_loop():
         while True:
+            await asyncio.sleep(JOURNAL_COMPACT_INTERVAL_SECONDS)
             try:
-                await check_subscription_alerts(app)
+                if user_repo.pending_bytes() >= JOURNAL_COMPACT_BYTES:
+                    compact_user_store()
             except Exception as e:
-                logging.error(f"خطا در حلقه هشدار اشتراک: {e}")
-            await asyncio.sleep(3 * 3600)  # هر 3 ساعت یکبار اجرا شود
+                logging.error(f"خطا در فشرده‌سازی ذخیره‌ساز کاربران: {e}")
+
+    drop_legacy_link_counters()
+    loops = [
+        alert_loop(),
+        subscription_alert_loop(app),
+        store_compaction_loop(),
+        dirty_flush_loop(),
+        outbox_loop(),
+    ]
+    if SHEET_MIRROR_INTERVAL_SECONDS > 0:
+        loops.append(sheet_mirror_loop())
+    if REMOVAL_INTERVAL_SECONDS > 0:
+        loops.append(member_removal_loop(app.bot))
+    if TWELVE_API_KEY:
+        loops.append(market_refresh_loop())
+    loop_tasks = [asyncio.create_task(coro) for coro in loops]
+
+    # Render هنگام deploy/restart سیگنال SIGTERM می‌فرستد؛ بدون handler پردازه
+    # بدون اجرای finally بسته می‌شود و تغییرات dirty از دست می‌رود
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # ویندوز: SIGINT همچنان با لغو task به finally می‌رسد
 
-    asyncio.create_task(alert_loop())
-    asyncio.create_task(subscription_alert_loop())
-    await asyncio.Event().wait()
+    try:
+        await stop_event.wait()
+        logging.info("🛑 دریافت سیگنال خاموشی؛ ذخیره تغییرات...")
+    finally:
+        # ابتدا ورودی‌ها (تلگرام، وب‌سرور) و حلقه‌های پس‌زمینه متوقف می‌شوند تا پس از
+        # ذخیره نهایی چیزی dirty نشود و هیچ حلقه‌ای به ذخیره‌ساز بسته‌شده دسترسی نداشته باشد
+        try:
+            await app.updater.stop()
+            await app.stop()
+            await app.shutdown()
+        except Exception as e:
+            logging.error(f"خطا در توقف ربات: {e}")
+        if web_task.done() and not web_task.cancelled() and web_task.exception() is None:
+            await web_task.result().cleanup()
+        else:
+            web_task.cancel()
+        pending = loop_tasks + list(_background_tasks)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+        # ذخیره تغییرات باقی‌مانده پیش از خاموش شدن
+        flush_dirty_users()
+        save_rate_limits()
+        user_repo.close()
+        await close_http_session()
 
 if __name__ == "__main__":
     asyncio.run(main())
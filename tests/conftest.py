@@ -0,0 +1,31 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# main.py فایل‌های داده را در پوشه جاری می‌سازد؛ تست‌ها در پوشه موقت اجرا می‌شوند
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp(prefix="bot-tests-"))
+
+# کانال‌های سطوح پیش‌فرض (بدون chat_id، حذف و تأیید عضویت غیرفعال است)
+os.environ.setdefault("CHANNEL_ID", "-1001000000001")
+os.environ.setdefault("CIP_CHANNEL_ID", "-1001000000002")
+
+
+@pytest.fixture
+def fresh_store(monkeypatch, tmp_path):
+    """ذخیره‌ساز خالی کاربران در پوشه موقت همین تست"""
+    import main
+
+    monkeypatch.chdir(tmp_path)
+    repo = main.create_user_repository()
+    monkeypatch.setattr(main, "user_repo", repo)
+    monkeypatch.setattr(main, "users_data", repo.load_all())
+    monkeypatch.setattr(main, "entitlements", {})
+    monkeypatch.setattr(main, "entitlement_cache", {})
+    main.dirty_users.clear()
+    yield repo
+    main.dirty_users.clear()
+    repo.close()
@@ -0,0 +1,44 @@
+"""Bot جعلی تلگرام برای تست‌ها: فراخوانی‌ها را با زمان ثبت می‌کند و خطا تزریق می‌کند"""
+import asyncio
+import itertools
+import time
+from types import SimpleNamespace
+
+
+class FakeBot:
+    def __init__(self, latency=0.0, fail=None):
+        self.latency = latency
+        self.fail = fail  # fail(method, kwargs) → استثنا برای پرتاب یا None
+        self.calls = []   # (زمان monotonic، نام متد، kwargs)
+        self._links = itertools.count(1)
+
+    async def _call(self, method, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        error = self.fail(method, kwargs) if self.fail else None
+        if error is not None:
+            raise error
+        self.calls.append((time.monotonic(), method, kwargs))
+        return True
+
+    def called(self, method):
+        return [kwargs for _, name, kwargs in self.calls if name == method]
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return await self._call("send_message", chat_id=chat_id, text=text, **kwargs)
+
+    async def ban_chat_member(self, chat_id, user_id, **kwargs):
+        return await self._call("ban_chat_member", chat_id=chat_id, user_id=user_id)
+
+    async def unban_chat_member(self, chat_id, user_id, only_if_banned=False, **kwargs):
+        return await self._call("unban_chat_member", chat_id=chat_id, user_id=user_id, only_if_banned=only_if_banned)
+
+    async def approve_chat_join_request(self, chat_id, user_id, **kwargs):
+        return await self._call("approve_chat_join_request", chat_id=chat_id, user_id=user_id)
+
+    async def decline_chat_join_request(self, chat_id, user_id, **kwargs):
+        return await self._call("decline_chat_join_request", chat_id=chat_id, user_id=user_id)
+
+    async def create_chat_invite_link(self, chat_id, **kwargs):
+        await self._call("create_chat_invite_link", chat_id=chat_id, **kwargs)
+        return SimpleNamespace(invite_link=f"https://t.me/+fake{next(self._links)}")
@@ -0,0 +1,70 @@
+"""Broadcaster با Bot جعلی: نرخ کلی، فاصله پیام‌های یک چت و RetryAfter"""
+import asyncio
+import time
+
+from telegram.error import Forbidden, RetryAfter
+
+import main
+from fakes import FakeBot
+
+
+def run_broadcast(bot, chat_ids, rate, concurrency=10, per_chat_interval=0.0):
+    broadcaster = main.Broadcaster(
+        bot, bucket=main.TokenBucket(rate), concurrency=concurrency, per_chat_interval=per_chat_interval
+    )
+
+    async def scenario():
+        started = time.monotonic()
+        results = await broadcaster.broadcast([(chat_id, {"text": "hi"}) for chat_id in chat_ids])
+        return results, time.monotonic() - started
+
+    return asyncio.run(scenario())
+
+
+def test_throughput_capped_by_global_rate():
+    rate, count, latency = 50, 150, 0.05
+    bot = FakeBot(latency=latency)
+    results, elapsed = run_broadcast(bot, range(count), rate)
+    print(f"\n{count} messages at {latency * 1000:.0f}ms/call: {elapsed:.2f}s, {count / elapsed:.0f} msg/s")
+
+    assert all(status == "sent" for status, _ in results.values())
+    # سطل پر شروع می‌شود (rate پیام انفجاری)، سپس rate پیام در ثانیه
+    assert elapsed >= (count - rate) / rate
+    # همزمان، نه پشت سر هم (پشت سر هم: count * latency = 7.5 ثانیه)
+    assert elapsed < count * latency / 2
+    sent_at = sorted(at for at, _, _ in bot.calls)
+    for i, at in enumerate(sent_at):
+        in_window = sum(1 for other in sent_at[i:] if other - at < 1.0)
+        assert in_window <= 2 * rate
+
+
+def test_per_chat_spacing():
+    bot = FakeBot()
+    run_broadcast(bot, [7] * 4 + [8] * 4, rate=1000, per_chat_interval=0.2)
+    for chat_id in (7, 8):
+        times = [at for at, _, kwargs in bot.calls if kwargs["chat_id"] == chat_id]
+        assert len(times) == 4
+        assert all(b - a >= 0.19 for a, b in zip(times, times[1:]))
+
+
+def test_retry_after_pauses_everyone_and_retries():
+    failed_at = []
+
+    def fail(method, kwargs):
+        if kwargs["chat_id"] == 5 and not failed_at:
+            failed_at.append(time.monotonic())
+            return RetryAfter(1)
+        if kwargs["chat_id"] == 9:
+            return Forbidden("bot was blocked by the user")
+
+    before = main.broadcast_stats["retry_after"]
+    bot = FakeBot(latency=0.01, fail=fail)
+    results, _ = run_broadcast(bot, range(40), rate=20)
+
+    assert results[5] == ("sent", None)
+    assert results[9][0] == "blocked"
+    assert sum(1 for status, _ in results.values() if status == "sent") == 39
+    assert main.broadcast_stats["retry_after"] - before == 1
+    # پس از RetryAfter هیچ پیامی تا پایان مهلت ارسال نمی‌شود (توکن‌های در جریان مستثنا هستند)
+    paused = [at for at, _, _ in bot.calls if failed_at[0] + 0.05 < at < failed_at[0] + 0.95]
+    assert paused == []
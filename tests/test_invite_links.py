@@ -0,0 +1,44 @@
+"""لینک دعوت: ضربه‌های تکراری و هم‌زمان یک لینک و یک سهمیه مصرف می‌کنند"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import main
+from fakes import FakeBot
+
+HOTLINE = next(tier for tier in main.CHANNEL_TIERS if tier.key == "Hotline")
+
+
+@pytest.fixture(autouse=True)
+def fresh_links(monkeypatch):
+    monkeypatch.setattr(main, "invite_link_cache", {})
+    monkeypatch.setattr(main.link_limiters[HOTLINE.key], "_hits", {})
+
+
+def test_concurrent_taps_share_one_link():
+    bot = FakeBot(latency=0.05)
+    context = SimpleNamespace(bot=bot)
+
+    async def taps():
+        return await asyncio.gather(*(main.get_or_create_invite_link(context, "42", HOTLINE) for _ in range(3)))
+
+    results = asyncio.run(taps())
+    assert len(bot.called("create_chat_invite_link")) == 1
+    assert len({link for link, error in results}) == 1
+    assert all(error is None for _, error in results)
+    assert len(main.link_limiters[HOTLINE.key]._hits["42"]) == 1
+
+
+def test_repeat_tap_reuses_cached_link():
+    bot = FakeBot()
+    context = SimpleNamespace(bot=bot)
+
+    async def taps():
+        first = await main.get_or_create_invite_link(context, "42", HOTLINE)
+        second = await main.get_or_create_invite_link(context, "42", HOTLINE)
+        return first, second
+
+    first, second = asyncio.run(taps())
+    assert first == second
+    assert len(bot.called("create_chat_invite_link")) == 1
@@ -0,0 +1,72 @@
+"""موج هم‌زمان درخواست عضویت: تصمیم از جدول دسترسی در حافظه، بدون انتظار برای شیت"""
+import asyncio
+import time
+from datetime import date, timedelta
+from types import SimpleNamespace
+
+import main
+from fakes import FakeBot
+
+BURST = 1000
+HOTLINE = next(tier for tier in main.CHANNEL_TIERS if tier.key == "Hotline")
+
+
+def join_update(user_id, chat_id):
+    return SimpleNamespace(chat_join_request=SimpleNamespace(
+        from_user=SimpleNamespace(id=user_id),
+        chat=SimpleNamespace(id=chat_id),
+    ))
+
+
+def test_burst_of_join_requests(monkeypatch, fresh_store):
+    sheet_released = asyncio.Event()
+    sheet_calls = []
+
+    async def slow_sheet(user_id, user_data):
+        # بررسی دوباره پس‌زمینه تا پایان همه تصمیم‌ها معطل می‌ماند
+        sheet_calls.append(user_id)
+        await sheet_released.wait()
+        return user_data
+
+    monkeypatch.setattr(main, "sync_user_data", slow_sheet)
+    start = (date.today() - timedelta(days=5)).isoformat()
+    expired_start = (date.today() - timedelta(days=60)).isoformat()
+    entitled, expired = range(1, 501), range(501, 801)  # 801..1000 ناشناخته
+    for user_id in [*entitled, *expired]:
+        main.users_data[str(user_id)] = main.UserRecord.from_dict({
+            "phone": f"912{user_id:07d}",
+            "Hotline": True,
+            "subscription_days": 30,
+            "subscription_start": start if user_id in entitled else expired_start,
+        })
+        main.mark_dirty(str(user_id))
+
+    bot = FakeBot(latency=0.001)
+    context = SimpleNamespace(bot=bot)
+    latencies = []
+
+    async def one(user_id):
+        started = time.perf_counter()
+        await main.handle_chat_join_request(join_update(user_id, HOTLINE.chat_id), context)
+        latencies.append(time.perf_counter() - started)
+
+    async def scenario():
+        started = time.perf_counter()
+        await asyncio.gather(*(one(user_id) for user_id in range(1, BURST + 1)))
+        elapsed = time.perf_counter() - started
+        sheet_released.set()
+        await asyncio.gather(*main._background_tasks)
+        return elapsed
+
+    elapsed = asyncio.run(scenario())
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99)]
+    print(f"\n{BURST} join requests: {elapsed * 1000:.0f} ms total, p99 {p99 * 1000:.1f} ms")
+
+    approved = {k["user_id"] for k in bot.called("approve_chat_join_request")}
+    declined = {k["user_id"] for k in bot.called("decline_chat_join_request")}
+    assert approved == {str(user_id) for user_id in entitled}
+    assert declined == {str(user_id) for user_id in range(501, BURST + 1)}
+    # فقط تأییدشده‌ها در پس‌زمینه با شیت بررسی می‌شوند و تصمیم منتظر آن نمی‌ماند
+    assert len(sheet_calls) == len(entitled)
+    assert elapsed < 2.0
@@ -0,0 +1,181 @@
+"""داده بازار: سرور جایگزین TwelveData که پاسخ‌های ضبط‌شده tests/fixtures/twelvedata را پخش می‌کند"""
+import asyncio
+import json
+import os
+import time
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import main
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures", "twelvedata")
+TODAY = datetime(2026, 10, 14, 9, 30, tzinfo=timezone.utc)  # چهارشنبه؛ کندل هفته از 2026-10-12 و ماه از 2026-10-01 باز است
+
+
+def load_fixture(symbol, interval):
+    path = os.path.join(FIXTURES_DIR, f"{symbol.replace('/', '')}_{interval}.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def fixture_candles(symbol, interval):
+    return {
+        date.fromisoformat(value["datetime"]): (float(value["high"]), float(value["low"]), float(value["close"]))
+        for value in load_fixture(symbol, interval)["values"]
+    }
+
+
+def make_twelvedata_app(calls):
+    """هر نماد از فایل ضبط‌شده؛ نماد ناشناخته خطای همان نماد را مثل TwelveData برمی‌گرداند"""
+    async def time_series(request):
+        symbols = request.query["symbol"].split(",")
+        interval = request.query["interval"]
+        outputsize = int(request.query["outputsize"])
+        calls.append((interval, tuple(symbols)))
+        responses = {}
+        for symbol in symbols:
+            series = load_fixture(symbol, interval)
+            if series is None:
+                responses[symbol] = {
+                    "code": 400,
+                    "message": f"**symbol** {symbol} is not available with your plan or does not exist",
+                    "status": "error",
+                }
+            else:
+                responses[symbol] = dict(series, values=series["values"][:outputsize])
+        if len(symbols) == 1:
+            return web.json_response(responses[symbols[0]])
+        return web.json_response(responses)
+
+    app = web.Application()
+    app.router.add_get("/time_series", time_series)
+    return app
+
+
+class Clock:
+    """ساعت قابل جابه‌جایی برای datetime.now و time.time داخل main"""
+
+    def __init__(self, now):
+        self.now = now
+
+    def advance(self, **kwargs):
+        self.now += timedelta(**kwargs)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock(TODAY)
+
+    class FrozenDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return clock.now if tz else clock.now.replace(tzinfo=None)
+
+    class FrozenTime:
+        def time(self):
+            return clock.now.timestamp()
+
+        def __getattr__(self, name):
+            return getattr(time, name)
+
+    monkeypatch.setattr(main, "datetime", FrozenDatetime)
+    monkeypatch.setattr(main, "time", FrozenTime())
+    return clock
+
+
+@pytest.fixture(autouse=True)
+def fresh_market_state(monkeypatch):
+    main.market_series_cache.clear()
+    monkeypatch.setattr(main, "market_data_stats", dict.fromkeys(main.market_data_stats, 0))
+    monkeypatch.setattr(main.quote_batcher.credits, "_hits", {})
+    monkeypatch.setattr(main.quote_batcher.credits, "limit", 1000)
+
+
+def run_with_provider(monkeypatch, scenario):
+    async def runner():
+        calls = []
+        server = TestServer(make_twelvedata_app(calls))
+        await server.start_server()
+        monkeypatch.setattr(main.market_data_provider, "base_url", str(server.make_url("")).rstrip("/"))
+        monkeypatch.setattr(main.market_data_provider, "api_key", "test")
+        try:
+            return await scenario(calls)
+        finally:
+            await main.close_http_session()
+            await server.close()
+
+    return asyncio.run(runner())
+
+
+def test_one_provider_call_per_cache_window(monkeypatch, clock):
+    async def scenario(calls):
+        first = await asyncio.gather(*(main.get_asset_data("XAU/USD", "1w") for _ in range(50)))
+        after_first = len(calls)
+        again = await main.get_asset_data("XAU/USD", "1w")
+        after_hit = len(calls)
+
+        # بسته شدن کندل هفته (دوشنبه 2026-10-19) → پنجره جدید کش
+        clock.advance(days=5)
+        await main.get_asset_data("XAU/USD", "1w")
+        return first, again, after_first, after_hit, len(calls)
+
+    first, again, after_first, after_hit, total = run_with_provider(monkeypatch, scenario)
+    assert all(levels == first[0] for levels in first)
+    assert again == first[0]
+    assert (after_first, after_hit, total) == (1, 1, 2)
+
+
+def test_monthly_periods_share_one_series(monkeypatch, clock):
+    async def scenario(calls):
+        await asyncio.gather(*(main.get_asset_data("XAU/USD", period) for period in ("1m", "3m", "6m")))
+        return calls
+
+    calls = run_with_provider(monkeypatch, scenario)
+    assert calls == [("1month", ("XAU/USD",))]
+
+
+def test_symbols_batched_and_errors_mapped_per_symbol(monkeypatch, clock):
+    async def scenario(calls):
+        results = await asyncio.gather(*(
+            main.get_asset_data(symbol, "1w") for symbol in ("XAU/USD", "EUR/USD", "NASDAQ", "BAD/SYM")
+        ))
+        return calls, results
+
+    calls, (gold, euro, nasdaq, bad) = run_with_provider(monkeypatch, scenario)
+    # یک درخواست برای همه نمادها؛ NASDAQ با نام IXIC ارسال و به همان دارایی برگردانده می‌شود
+    assert calls == [("1week", ("XAU/USD", "EUR/USD", "IXIC", "BAD/SYM"))]
+    assert main.market_data_stats["credits"] == 4
+    assert bad is None
+    assert main.market_data_stats["errors"] == 1
+    high, low, close = fixture_candles("IXIC", "1week")[date(2026, 10, 5)]
+    assert nasdaq == main.compute_levels(high, low, close, main.PIP_SIZES["NASDAQ"])
+    assert gold is not None and euro is not None
+
+
+def test_levels_aggregate_only_closed_candles(monkeypatch, clock):
+    async def scenario(calls):
+        return (
+            await main.get_asset_data("XAU/USD", "1w"),
+            await main.get_asset_data("XAU/USD", "3m"),
+        )
+
+    weekly, quarterly = run_with_provider(monkeypatch, scenario)
+
+    # کندل باز هفته 2026-10-12 کنار گذاشته می‌شود
+    high, low, close = fixture_candles("XAU/USD", "1week")[date(2026, 10, 5)]
+    assert weekly == main.compute_levels(high, low, close, main.PIP_SIZES["XAU/USD"])
+
+    # سه ماه بسته‌شده قبل از ماه جاری (اکتبر باز است): ژوئیه تا سپتامبر
+    months = fixture_candles("XAU/USD", "1month")
+    closed = [months[date(2026, m, 1)] for m in (9, 8, 7)]
+    assert quarterly == main.compute_levels(
+        max(c[0] for c in closed),
+        min(c[1] for c in closed),
+        closed[0][2],
+        main.PIP_SIZES["XAU/USD"],
+    )
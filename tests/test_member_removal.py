@@ -0,0 +1,116 @@
+"""حذف خودکار کاربران منقضی‌شده از کانال‌ها با Bot جعلی"""
+import asyncio
+from datetime import date, timedelta
+
+import pytest
+
+import main
+from fakes import FakeBot
+
+HOTLINE = next(tier for tier in main.CHANNEL_TIERS if tier.key == "Hotline")
+
+
+class Crash(BaseException):
+    """توقف ناگهانی پردازه وسط اجرا (از except Exception عبور می‌کند)"""
+
+
+def add_user(user_id, start_days_ago, days=30):
+    main.users_data[user_id] = main.UserRecord.from_dict({
+        "phone": f"912{int(user_id):07d}",
+        "name": user_id,
+        "Hotline": True,
+        "subscription_days": days,
+        "subscription_start": (date.today() - timedelta(days=start_days_ago)).isoformat(),
+    })
+    main.mark_dirty(user_id)
+
+
+@pytest.fixture
+def removal(monkeypatch, fresh_store):
+    async def sheet_confirms(user_id, user_data):
+        return user_data
+
+    monkeypatch.setattr(main, "sync_user_data", sheet_confirms)
+    monkeypatch.setattr(main, "telegram_send_bucket", main.TokenBucket(100000))
+    monkeypatch.setattr(main, "REMOVAL_BATCH_SIZE", 10)
+    monkeypatch.setattr(main, "REMOVAL_BATCH_PAUSE_SECONDS", 0)
+    expired = [str(i) for i in range(1, 51)]
+    valid = [str(i) for i in range(101, 151)]
+    for user_id in expired:
+        add_user(user_id, start_days_ago=60)
+    for user_id in valid:
+        add_user(user_id, start_days_ago=5)
+    return expired, valid
+
+
+def banned_users(bot):
+    return [str(kwargs["user_id"]) for kwargs in bot.called("ban_chat_member")]
+
+
+def test_dry_run_makes_no_telegram_calls(removal):
+    expired, _ = removal
+    bot = FakeBot()
+    before = main.removal_stats["dry_run"]
+    asyncio.run(main.remove_expired_members(bot, dry_run=True))
+    assert bot.calls == []
+    assert main.removal_stats["dry_run"] - before == len(expired)
+
+
+def test_removes_expired_and_never_touches_valid_users(removal):
+    expired, valid = removal
+    bot = FakeBot()
+    asyncio.run(main.remove_expired_members(bot, dry_run=False))
+
+    assert sorted(banned_users(bot), key=int) == expired
+    assert all(kwargs["chat_id"] == HOTLINE.chat_id for kwargs in bot.called("ban_chat_member"))
+    # ban و سپس unban تا کاربر پس از تمدید بتواند دوباره عضو شود
+    assert [k["user_id"] for k in bot.called("unban_chat_member")] == [k["user_id"] for k in bot.called("ban_chat_member")]
+    assert all(k["only_if_banned"] for k in bot.called("unban_chat_member"))
+    assert not set(banned_users(bot)) & set(valid)
+
+
+def test_user_renewed_in_sheet_is_skipped(monkeypatch, removal):
+    expired, _ = removal
+    renewed = expired[0]
+
+    async def sheet_sync(user_id, user_data):
+        if user_id == renewed:
+            user_data["subscription_start"] = date.today().isoformat()
+        return user_data
+
+    monkeypatch.setattr(main, "sync_user_data", sheet_sync)
+    bot = FakeBot()
+    asyncio.run(main.remove_expired_members(bot, dry_run=False))
+    assert renewed not in banned_users(bot)
+    assert len(banned_users(bot)) == len(expired) - 1
+
+
+def test_checkpoint_resumes_after_crash(removal):
+    expired, valid = removal
+    crash_at = 25
+
+    def crash(method, kwargs):
+        if method == "ban_chat_member" and len(first.called("ban_chat_member")) == crash_at:
+            return Crash()
+
+    first = FakeBot(fail=crash)
+    with pytest.raises(Crash):
+        asyncio.run(main.remove_expired_members(first, dry_run=False))
+    done_before_crash = banned_users(first)
+    assert len(done_before_crash) == crash_at
+
+    second = FakeBot()
+    asyncio.run(main.remove_expired_members(second, dry_run=False))
+    resumed = banned_users(second)
+
+    # دسته‌های کامل قبل از توقف ذخیره شده‌اند و تکرار نمی‌شوند؛ فقط دسته نیمه‌کاره دوباره اجرا می‌شود
+    saved = crash_at - crash_at % main.REMOVAL_BATCH_SIZE
+    assert not set(resumed) & set(done_before_crash[:saved])
+    assert set(done_before_crash) | set(resumed) == set(expired)
+    assert len(resumed) == len(expired) - saved
+    assert not (set(done_before_crash) | set(resumed)) & set(valid)
+
+    # اجرای سوم کاری برای انجام ندارد
+    third = FakeBot()
+    asyncio.run(main.remove_expired_members(third, dry_run=False))
+    assert third.calls == []
@@ -0,0 +1,100 @@
+"""کلاینت HTTP گوگل شیت نباید event loop را مسدود کند (سرور جایگزین محلی و کند)"""
+import asyncio
+import time
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import main
+
+SHEET_DELAY_SECONDS = 0.5
+
+
+def make_sheet_app(delay, calls):
+    """جایگزین Apps Script: هر درخواست پس از delay ثانیه پاسخ می‌دهد"""
+    async def handle(request):
+        calls.append(request.query.get("phone"))
+        await asyncio.sleep(delay)
+        return web.json_response({
+            "status": "found",
+            "phone": request.query.get("phone"),
+            "Hotline": "T",
+            "CIP": "F",
+            "days": 30,
+            "start_date": "2026-10-01",
+        })
+
+    app = web.Application()
+    app.router.add_get("/exec", handle)
+    return app
+
+
+class FakeMessage:
+    def __init__(self):
+        self.replied_at = None
+
+    async def reply_text(self, text, **kwargs):
+        self.replied_at = time.monotonic()
+
+
+async def run_with_sheet(monkeypatch, scenario):
+    calls = []
+    server = TestServer(make_sheet_app(SHEET_DELAY_SECONDS, calls))
+    await server.start_server()
+    monkeypatch.setattr(main, "GOOGLE_SHEET_URL", str(server.make_url("/exec")))
+    try:
+        return await scenario(calls)
+    finally:
+        await main.close_http_session()
+        await server.close()
+
+
+def test_handlers_served_while_sheet_call_pending(monkeypatch):
+    async def scenario(calls):
+        started = time.monotonic()
+        sheet_call = asyncio.create_task(main.get_user_from_sheet("09120000000"))
+        await asyncio.sleep(0.05)
+        assert calls and not sheet_call.done()
+
+        # هندلر دیگری در حالی که درخواست شیت در جریان است
+        message = FakeMessage()
+        await main.show_main_menu(message, None, main.UserRecord.from_dict({"phone": "9120000001"}))
+
+        # تأخیر event loop در طول انتظار
+        lag = 0.0
+        while not sheet_call.done():
+            tick = time.monotonic()
+            await asyncio.sleep(0.01)
+            lag = max(lag, time.monotonic() - tick - 0.01)
+
+        return started, message.replied_at, time.monotonic(), lag, sheet_call.result()
+
+    started, replied_at, finished, lag, result = asyncio.run(run_with_sheet(monkeypatch, scenario))
+    assert result["status"] == "found"
+    assert finished - started >= SHEET_DELAY_SECONDS
+    assert replied_at - started < 0.2
+    assert lag < 0.1
+
+
+def test_sheet_calls_share_pool_concurrently(monkeypatch):
+    phones = [f"0912000000{i}" for i in range(5)]
+
+    async def scenario(calls):
+        started = time.monotonic()
+        results = await asyncio.gather(*(main.get_user_from_sheet(phone) for phone in phones))
+        return time.monotonic() - started, results
+
+    elapsed, results = asyncio.run(run_with_sheet(monkeypatch, scenario))
+    assert [r["status"] for r in results] == ["found"] * len(phones)
+    # پنج درخواست موازی (سقف SHEET_MAX_CONCURRENCY) نه پشت سر هم
+    assert elapsed < 2 * SHEET_DELAY_SECONDS
+
+
+def test_concurrent_reads_for_one_phone_are_merged(monkeypatch):
+    async def scenario(calls):
+        results = await asyncio.gather(*(main.get_user_from_sheet("09120000000") for _ in range(10)))
+        return calls, results
+
+    calls, results = asyncio.run(run_with_sheet(monkeypatch, scenario))
+    assert len(calls) == 1
+    assert all(r == results[0] for r in results)